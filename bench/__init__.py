@@ -0,0 +1,6 @@
+"""Offline benchmark of the Lambda handlers, see ``python -m bench --help``."""
+import pathlib
+
+from localrun import COMMON_LAYER_DIR, FUNCTIONS_DIR, ROOT_DIR  # noqa: F401
+
+BASELINE_FILE = pathlib.Path(__file__).resolve().parent / "baseline.json"
@@ -0,0 +1,133 @@
+"""Benchmark the Lambda handlers offline and gate on regressions.
+
+    python -m bench                      # run all scenarios, print the results
+    python -m bench --check              # fail if worse than bench/baseline.json
+    python -m bench --update-baseline    # record the current results as baseline
+
+AWS calls and requests to the replay server are deterministic and may not
+grow at all. Peak memory and wall time are compared with a tolerance, wall
+time being the noisiest on shared CI runners.
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+
+from bench import BASELINE_FILE
+from bench.harness import SCENARIOS, run
+
+DEFAULT_BRANDS = 5
+DEFAULT_LISTINGS = 40
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.split("\n")[0])
+    parser.add_argument("scenarios", nargs="*", help=f"default: all of {', '.join(SCENARIOS)}")
+    parser.add_argument("--brands", type=int, default=DEFAULT_BRANDS)
+    parser.add_argument("--listings", type=int, default=DEFAULT_LISTINGS, help="per brand")
+    parser.add_argument("--check", action="store_true", help="compare with the baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25)
+    parser.add_argument("--time-tolerance", type=float, default=1.0)
+    parser.add_argument("--output", help="write the full results as JSON")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    return args
+
+
+def print_results(results: dict):
+    header = f"{'scenario':<20}{'run':<8}{'wall ms':>10}{'peak KiB':>10}{'AWS calls':>11}{'HTTP':>6}{'stdout B':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, runs in results.items():
+        for result in runs:
+            print(
+                f"{name:<20}{result['run']:<8}{result['wall_ms']:>10.1f}{result['peak_kib']:>10}"
+                f"{sum(result['aws_calls'].values()):>11}{result['http_requests']:>6}"
+                f"{result['stdout_bytes']:>10}"
+            )
+            for operation, count in result["aws_calls"].items():
+                print(f"{'':<28}{operation:<40}{count:>6}")
+
+
+def find_regressions(results: dict, baseline: dict, memory_tolerance: float, time_tolerance: float):
+    regressions = []
+    for name, runs in results.items():
+        baseline_runs = {run["run"]: run for run in baseline["results"].get(name, [])}
+        for result in runs:
+            expected = baseline_runs.get(result["run"])
+            if expected is None:
+                continue
+            label = f"{name}/{result['run']}"
+
+            for operation, count in result["aws_calls"].items():
+                if count > expected["aws_calls"].get(operation, 0):
+                    regressions.append(
+                        f"{label}: {operation} {expected['aws_calls'].get(operation, 0)} -> {count}"
+                    )
+            if result["http_requests"] > expected["http_requests"]:
+                regressions.append(
+                    f"{label}: HTTP requests {expected['http_requests']} -> {result['http_requests']}"
+                )
+            if result["peak_kib"] > expected["peak_kib"] * (1 + memory_tolerance):
+                regressions.append(
+                    f"{label}: peak memory {expected['peak_kib']} -> {result['peak_kib']} KiB"
+                )
+            if result["wall_ms"] > expected["wall_ms"] * (1 + time_tolerance):
+                regressions.append(
+                    f"{label}: wall time {expected['wall_ms']:.0f} -> {result['wall_ms']:.0f} ms"
+                )
+    return regressions
+
+
+def main() -> int:
+    args = parse_args()
+    volumes = {"brands": args.brands, "listings": args.listings}
+
+    # The handlers' own output is counted per run, not shown
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = run(args.scenarios, args.brands, args.listings)
+
+    for runs in results.values():
+        for result in runs:
+            result.pop("response")
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"volumes": volumes, "results": results}, file, indent=2)
+
+    if args.update_baseline:
+        with open(BASELINE_FILE, "w", encoding="utf-8") as file:
+            json.dump({"volumes": volumes, "results": results}, file, indent=2)
+            file.write("\n")
+        print(f"\nBaseline written to {BASELINE_FILE}")
+
+    if args.check:
+        with open(BASELINE_FILE, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        if baseline["volumes"] != volumes:
+            print(f"\nBaseline was recorded with {baseline['volumes']}, not {volumes}")
+            return 2
+
+        regressions = find_regressions(
+            results, baseline, args.memory_tolerance, args.time_tolerance
+        )
+        if regressions:
+            print("\nRegressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regressions against the baseline")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
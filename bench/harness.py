@@ -0,0 +1,259 @@
+"""Runs the Lambda handlers against moto and the replay server and measures them.
+
+Each scenario gets a fresh set of moto resources and a fresh copy of the
+function module, then invokes the handler twice: a first run where every
+listing is new and a repeat run where every listing is already stored.
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from unittest import mock
+
+BENCH_ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "eu-north-1",
+    "AWS_ACCESS_KEY_ID": "bench",
+    "AWS_SECRET_ACCESS_KEY": "bench",
+    "S3_HTML_BUCKET": "bench-html",
+    "DYNAMO_TABLE": "articles",
+    "STATE_TABLE": "watch_state",
+    "STATS_TABLE": "brand_stats",
+    "DIGEST_MODE": "single",
+    "CONFIG_TTL_SECONDS": "3600",
+    "LOG_LEVEL": "WARNING",
+    "TRACE_EXPORTER": "none",
+    "METRICS_EXPORTER": "memory",
+}
+
+# Read by the shared layer when it is imported, so set before importing it
+os.environ.update(BENCH_ENVIRONMENT)
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+from bench import COMMON_LAYER_DIR  # noqa: E402
+from bench.replay import Catalogue, ReplayDriver, ReplayServer  # noqa: E402
+from localrun import load_function, reset_common_state  # noqa: E402
+
+sys.path.insert(0, str(COMMON_LAYER_DIR))
+
+RECIPIENT = "recipient@example.com"
+SENDER = "sender@example.com"
+BRAND_SOURCES = ("sellpy", "vinted-api", "vinted-web")
+
+
+class Scenario:
+    def __init__(self, catalogue: Catalogue, server: ReplayServer):
+        self.catalogue = catalogue
+        self.server = server
+        self.aws_calls = Counter()
+        self.slept = 0.0
+
+    def count_aws_call(self, event_name, **kwargs):
+        # before-call.<service>.<operation>
+        self.aws_calls[event_name.split(".", 1)[1]] += 1
+
+    def sleep(self, seconds):
+        # Politeness delays are counted, not waited for
+        self.slept += seconds
+
+    def measure(self, label: str, handler, event: dict) -> dict:
+        aws_calls = Counter(self.aws_calls)
+        http_requests = sum(self.server.requests.values())
+        slept = self.slept
+        stdout = io.StringIO()
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(stdout):
+            response = handler(event, None)
+        wall_ms = (time.perf_counter() - started) * 1000
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return {
+            "run": label,
+            "wall_ms": round(wall_ms, 1),
+            "peak_kib": round(peak_bytes / 1024),
+            "aws_calls": dict(sorted((self.aws_calls - aws_calls).items())),
+            "http_requests": sum(self.server.requests.values()) - http_requests,
+            "stdout_bytes": len(stdout.getvalue().encode("utf-8")),
+            "sleep_skipped_s": round(self.slept - slept, 1),
+            "response": response,
+        }
+
+
+@contextlib.contextmanager
+def aws_stand_ins(catalogue: Catalogue, server: ReplayServer):
+    with mock_aws(), mock.patch.dict(os.environ):
+        boto3.setup_default_session()
+        reset_common_state()
+        scenario = Scenario(catalogue, server)
+
+        for table, key in (("articles", "id"), ("watch_state", "name")):
+            boto3.client("dynamodb").create_table(
+                TableName=table,
+                KeySchema=[{"AttributeName": key, "KeyType": "HASH"}],
+                AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"}],
+                BillingMode="PAY_PER_REQUEST",
+            )
+        boto3.client("dynamodb").create_table(
+            TableName=os.environ["STATS_TABLE"],
+            KeySchema=[
+                {"AttributeName": "source", "KeyType": "HASH"},
+                {"AttributeName": "brand", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "source", "AttributeType": "S"},
+                {"AttributeName": "brand", "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        boto3.client("s3").create_bucket(
+            Bucket=os.environ["S3_HTML_BUCKET"],
+            CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_DEFAULT_REGION"]},
+        )
+        os.environ["SQS_EMAIL_QUEUE"] = boto3.client("sqs").create_queue(
+            QueueName="email-queue"
+        )["QueueUrl"]
+        os.environ["SNS_ARN"] = boto3.client("sns").create_topic(Name="bench")["TopicArn"]
+
+        ssm = boto3.client("ssm")
+        ssm.put_parameter(Name="/ses/email/recipient", Value=RECIPIENT, Type="String")
+        ssm.put_parameter(Name="/ses/email/sender", Value=SENDER, Type="String")
+        for source in BRAND_SOURCES:
+            ssm.put_parameter(
+                Name=f"/serverless-scraper/brands/{source}",
+                Value=",".join(catalogue.brands),
+                Type="StringList",
+            )
+        for address in (SENDER, RECIPIENT):
+            boto3.client("ses").verify_email_identity(EmailAddress=address)
+
+        # Counted from here on, the setup calls above are not part of a run
+        boto3.DEFAULT_SESSION.events.register("before-call", scenario.count_aws_call)
+        with mock.patch("time.sleep", scenario.sleep):
+            yield scenario
+
+
+def run_twice(scenario: Scenario, handler, event=None) -> list:
+    return [
+        scenario.measure("first", handler, dict(event or {})),
+        scenario.measure("repeat", handler, dict(event or {})),
+    ]
+
+
+def load_sellpy(scenario: Scenario):
+    module = load_function("sellpy-scraper")
+    module.SEARCH_URL = scenario.server.url + "/search?query={}&sortBy=saleStartedAt_desc"
+    module.create_driver = ReplayDriver
+    return module
+
+
+def run_sellpy(scenario: Scenario) -> list:
+    return run_twice(scenario, load_sellpy(scenario).lambda_handler)
+
+
+def load_vinted_api(scenario: Scenario):
+    module = load_function("vinted-api-scraper")
+    module.BASE_URL = scenario.server.url + "/"
+    module.API_URL = scenario.server.url + "/api/v2/catalog/items?per_page=96&search_text={}"
+    return module
+
+
+def run_vinted_api(scenario: Scenario) -> list:
+    return run_twice(scenario, load_vinted_api(scenario).lambda_handler)
+
+
+def run_vinted_web(scenario: Scenario, mode: str) -> list:
+    os.environ["SCRAPE_MODE"] = mode
+    module = load_function("vinted-web-scraper")
+    module.BASE_URL = scenario.server.url + "/"
+    module.API_URL = scenario.server.url + "/api/v2/catalog/items?per_page=96&search_text={}"
+    module.CATALOG_URL = scenario.server.url + "/catalog?search_text={}"
+    module.create_driver = ReplayDriver
+    return run_twice(scenario, module.lambda_handler)
+
+
+def run_email_send(scenario: Scenario) -> list:
+    # Queue the digests of one vinted-api run, then send them
+    load_vinted_api(scenario).lambda_handler({}, None)
+    module = load_function("email-send")
+
+    sqs = boto3.client("sqs")
+    messages = sqs.receive_message(
+        QueueUrl=os.environ["SQS_EMAIL_QUEUE"], MaxNumberOfMessages=10
+    ).get("Messages", [])
+    event = {
+        "Records": [
+            {"messageId": message["MessageId"], "body": message["Body"]}
+            for message in messages
+        ]
+    }
+    return [scenario.measure("batch", module.lambda_handler, event)]
+
+
+def run_digest_send(scenario: Scenario) -> list:
+    os.environ["DIGEST_MODE"] = "combined"
+    event = {"time": "2024-01-01T04:00:00Z"}
+    # Both scrapers save a fragment for the 04:00 window, which digest-send combines
+    load_vinted_api(scenario).lambda_handler(event, None)
+    load_sellpy(scenario).lambda_handler(event, None)
+
+    module = load_function("digest-send")
+    return [scenario.measure("window", module.lambda_handler, {"time": "2024-01-01T06:00:00Z"})]
+
+
+def run_cph_marathon(scenario: Scenario) -> list:
+    targets = [
+        {
+            "name": f"target-{index}",
+            "url": f"{scenario.server.url}/bibexchange?target={index}",
+            "interval_minutes": 0,
+            "region": {"start": "</h3>", "end": "background: #949494"},
+            "rules": [
+                {"contains": "There are currently no race numbers for sale", "status": "NO_TICKETS"},
+                {"contains": "In progress", "status": "IN_PROGRESS"},
+            ],
+            "default_status": "AVAILABLE",
+            "notify_on": ["AVAILABLE"],
+        }
+        for index in range(len(scenario.catalogue.brands))
+    ]
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+        json.dump(targets, file)
+    try:
+        module = load_function("cph-marathon-scraper")
+        module.TARGETS_FILE = file.name
+        return run_twice(scenario, module.lambda_handler)
+    finally:
+        os.remove(file.name)
+
+
+SCENARIOS = {
+    "sellpy": run_sellpy,
+    "vinted-api": run_vinted_api,
+    "vinted-web": lambda scenario: run_vinted_web(scenario, "hybrid"),
+    "vinted-web-browser": lambda scenario: run_vinted_web(scenario, "browser"),
+    "email-send": run_email_send,
+    "digest-send": run_digest_send,
+    "cph-marathon": run_cph_marathon,
+}
+
+
+def run(names, brands: int, listings: int) -> dict:
+    catalogue = Catalogue([f"benchbrand-{index:03d}" for index in range(brands)], listings)
+    results = {}
+
+    with ReplayServer(catalogue) as server:
+        for name in names:
+            with aws_stand_ins(catalogue, server) as scenario:
+                results[name] = SCENARIOS[name](scenario)
+
+    return results
@@ -0,0 +1,190 @@
+"""HTTP replay server and browser stand-in for the benchmark harness.
+
+The server answers the requests the scrapers make to the marketplaces with
+synthetic catalogues built from the fixture files in the function
+directories: the Vinted API items in api_response.json, the Vinted catalog
+grid item in gridItem.html and the bib-exchange samples of the CPH watcher.
+Every brand gets ``listings`` items, newest (highest id) first, so repeated
+runs see the same listings.
+"""
+import copy
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from bench import FUNCTIONS_DIR
+
+SELLPY_PAGE_SIZE = 24
+
+SELLPY_ARTICLE = (
+    '<article><a href="/item/{id}/{slug}"><img src="https://images.sellpy.net/{id}.jpg"></a>'
+    '<meta itemprop="brand" content="{brand}"><p>{brand} wool jacket</p>'
+    '<p itemprop="price">{price} kr</p></article>'
+)
+
+
+def read_fixture(*path) -> str:
+    with open(FUNCTIONS_DIR.joinpath(*path), "r", encoding="utf-8") as file:
+        return file.read()
+
+
+class Catalogue:
+    """Synthetic listings per brand, built once per benchmark run."""
+
+    def __init__(self, brands, listings):
+        self.brands = brands
+        self.listings = listings
+        self.api_items = json.loads(read_fixture("vinted-api-scraper", "api_response.json"))["items"]
+        self.grid_item = read_fixture("vinted-web-scraper", "gridItem.html")
+        self.bib_pages = [
+            read_fixture("cph-marathon-scraper", "sample-no-tickets.html"),
+            read_fixture("cph-marathon-scraper", "sample-pending.html"),
+        ]
+
+    def ids(self, brand):
+        offset = (self.brands.index(brand) + 1) * 1_000_000 if brand in self.brands else 0
+        return [offset + self.listings - i for i in range(self.listings)]
+
+    def vinted_api(self, brand) -> bytes:
+        items = []
+        for index, item_id in enumerate(self.ids(brand)):
+            item = copy.deepcopy(self.api_items[index % len(self.api_items)])
+            item["id"] = item_id
+            item["brand_title"] = brand
+            item["url"] = f"https://www.vinted.se/items/{item_id}-{brand}"
+            item["total_item_price"] = {"amount": str(100 + index), "currency_code": "SEK"}
+            items.append(item)
+        return json.dumps({"items": items}).encode("utf-8")
+
+    def vinted_catalog(self, brand) -> bytes:
+        grid = [
+            self.grid_item.replace("6586127731", str(item_id)).replace("Fedeli", brand)
+            for item_id in self.ids(brand)
+        ]
+        return f"<html><body>{''.join(grid)}</body></html>".encode("utf-8")
+
+    def sellpy_search(self, brand, pages) -> bytes:
+        articles = [
+            SELLPY_ARTICLE.format(id=item_id, slug=brand, brand=brand, price=200 + i)
+            for i, item_id in enumerate(self.ids(brand)[: pages * SELLPY_PAGE_SIZE])
+        ]
+        return f"<html><body>{''.join(articles)}</body></html>".encode("utf-8")
+
+    def bib_exchange(self, target) -> bytes:
+        return self.bib_pages[target % len(self.bib_pages)].encode("utf-8")
+
+
+class ReplayServer:
+    """Serves a Catalogue on localhost and counts the requests per route."""
+
+    def __init__(self, catalogue: Catalogue):
+        self.catalogue = catalogue
+        self.requests = Counter()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        replay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                route = url.path.strip("/").split("/")[0] or "home"
+                replay.requests[route] += 1
+
+                headers = {}
+                if route == "home":
+                    # The Vinted scrapers read their API token from this cookie
+                    headers["Set-Cookie"] = "access_token_web=bench; Path=/"
+                    body, content_type = b"<html></html>", "text/html"
+                elif route == "api":
+                    body = replay.catalogue.vinted_api(query.get("search_text", ""))
+                    content_type = "application/json"
+                elif route == "catalog":
+                    body = replay.catalogue.vinted_catalog(query.get("search_text", ""))
+                    content_type = "text/html"
+                elif route == "search":
+                    pages = int(query.get("page", "1"))
+                    body = replay.catalogue.sellpy_search(query.get("query", ""), pages)
+                    content_type = "text/html"
+                elif route == "bibexchange":
+                    body = replay.catalogue.bib_exchange(int(query.get("target", "0")))
+                    content_type = "text/html"
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class ReplayDriver:
+    """Stands in for the headless Chrome webdriver, backed by the replay server.
+
+    ``execute_script`` is only used by the scrapers to load more results, so
+    any script loads the next page of the current search.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._session = requests.Session()
+        self._url = None
+        self._pages = 1
+        self.page_source = ""
+
+    def get(self, url):
+        self._url = url
+        self._pages = 1
+        self._load()
+
+    @property
+    def current_url(self):
+        # Read by scraper_common.browser to tell that the driver is alive
+        return self._url
+
+    def execute_script(self, script, *args):
+        if "navigator.userAgent" in script:
+            return "bench"
+        self._pages += 1
+        self._load()
+
+    def get_cookies(self):
+        return [
+            {"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path}
+            for cookie in self._session.cookies
+        ]
+
+    def quit(self):
+        self._session.close()
+
+    def _load(self):
+        response = self._session.get(self._url, params={"page": self._pages})
+        self.page_source = response.text
@@ -1,12 +1,16 @@
 from typing import Tuple
 
 from aws_cdk import (
+    ArnFormat,
     Duration,
     Stack,
+    aws_iam as iam,
     aws_ses as ses,
     aws_ssm as ssm,
     aws_sqs as sqs,
     aws_s3 as s3,
+    aws_stepfunctions as sfn,
+    aws_stepfunctions_tasks as tasks,
     RemovalPolicy,
 )
 from constructs import Construct
@@ -14,19 +18,32 @@ from aws_cdk.aws_lambda import Code, Runtime, LayerVersion
 from aws_cdk.aws_lambda_event_sources import SqsEventSource
 from aws_cdk.aws_sns import Topic
 from aws_cdk.aws_dynamodb import TableV2, Attribute, AttributeType, Billing, Capacity
-from aws_cdk.aws_lambda_python_alpha import PythonFunction
-from aws_cdk.aws_events import Rule, Schedule
-from aws_cdk.aws_events_targets import LambdaFunction
+from aws_cdk.aws_lambda_python_alpha import PythonFunction, PythonLayerVersion
+from aws_cdk.aws_events import EventField, Rule, RuleTargetInput, Schedule
+from aws_cdk.aws_events_targets import LambdaFunction, SfnStateMachine
+
+
+# SSM paths loaded by scraper_common.config with GetParametersByPath
+CONFIG_PATHS = ("ses/email", "serverless-scraper")
+
+# Tiers of scraper_common.schedule, each scheduled run scrapes the brands in its tier
+SCHEDULE_TIERS = {
+    "fast": Schedule.rate(Duration.minutes(15)),
+    "hourly": Schedule.cron(minute="0"),
+    "daily": Schedule.cron(hour="4", minute="0"),
+}
 
 
 class WebScraperStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
-        self.create_second_hand_scrapers()
-        # self.create_cph_marathon_scraper()
+        common_lambda_layer = self.create_common_lambda_layer()
 
-    def create_second_hand_scrapers(self):
+        self.create_second_hand_scrapers(common_lambda_layer)
+        # self.create_cph_marathon_scraper(common_lambda_layer)
+
+    def create_second_hand_scrapers(self, common_lambda_layer):
         table_sellpy = self.create_sellpy_table()
         table_vinted = self.create_vinted_table()
 
@@ -41,6 +58,7 @@ class WebScraperStack(Stack):
 
         sellpy_scraper_function = self.create_sellpy_scraper_function(
             chrome_driver_lambda_layer,
+            common_lambda_layer,
             article_topic.topic_arn,
             table_sellpy.table_name,
             html_bucket.bucket_name,
@@ -48,23 +66,57 @@ class WebScraperStack(Stack):
         )
         vinted_web_scraper_function = self.create_vinted_web_scraper_function(
             chrome_driver_lambda_layer,
+            common_lambda_layer,
             article_topic.topic_arn,
             table_vinted.table_name,
             html_bucket.bucket_name,
             email_queue.queue_url,
         )
         vinted_api_scraper_function = self.create_vinted_api_scraper_function(
+            common_lambda_layer,
             article_topic.topic_arn,
             table_vinted.table_name,
             html_bucket.bucket_name,
             email_queue.queue_url,
         )
-        email_send_function = self.create_email_send_function(html_bucket.bucket_name)
+        email_send_function = self.create_email_send_function(
+            common_lambda_layer, html_bucket.bucket_name
+        )
 
-        daily_event_rule = self.create_daily_event_rule()
-        daily_event_rule.add_target(LambdaFunction(sellpy_scraper_function))
-        daily_event_rule.add_target(LambdaFunction(vinted_api_scraper_function))
-        # daily_event_rule.add_target(LambdaFunction(vinted_web_scraper_function))
+        if self.is_adaptive_scheduling():
+            event_rules = self.create_tier_event_rules()
+            brand_stats_table = self.create_brand_stats_table()
+            for function in (
+                sellpy_scraper_function,
+                vinted_web_scraper_function,
+                vinted_api_scraper_function,
+            ):
+                function.add_environment("STATS_TABLE", brand_stats_table.table_name)
+                brand_stats_table.grant_read_write_data(function)
+        else:
+            event_rules = {None: self.create_daily_event_rule()}
+
+        if self.node.try_get_context("orchestration") == "fanout":
+            sellpy_state_machine = self.create_fanout_state_machine(
+                "Sellpy", sellpy_scraper_function
+            )
+            vinted_api_state_machine = self.create_fanout_state_machine(
+                "VintedApi", vinted_api_scraper_function
+            )
+            for tier, event_rule in event_rules.items():
+                event_input = self.create_tier_event_input(tier)
+                event_rule.add_target(SfnStateMachine(sellpy_state_machine, input=event_input))
+                event_rule.add_target(
+                    SfnStateMachine(vinted_api_state_machine, input=event_input)
+                )
+        else:
+            for tier, event_rule in event_rules.items():
+                event_input = self.create_tier_event_input(tier)
+                event_rule.add_target(LambdaFunction(sellpy_scraper_function, event=event_input))
+                event_rule.add_target(
+                    LambdaFunction(vinted_api_scraper_function, event=event_input)
+                )
+        # event_rule.add_target(LambdaFunction(vinted_web_scraper_function))
 
         email_send_function.add_event_source(sqs_event_source)
         sender_email_param, recipient_email_param = self.get_ssm_params()
@@ -88,14 +140,29 @@ class WebScraperStack(Stack):
             email_send_function=email_send_function,
         )
 
-    def create_cph_marathon_scraper(self):
+        if self.node.try_get_context("digest_mode") == "combined":
+            digest_send_function = self.create_digest_send_function(
+                common_lambda_layer, html_bucket.bucket_name, email_queue.queue_url
+            )
+            digest_event_rule = self.create_digest_event_rule()
+            digest_event_rule.add_target(LambdaFunction(digest_send_function))
+
+            html_bucket.grant_read_write(digest_send_function)
+            html_bucket.grant_delete(digest_send_function)
+            email_queue.grant_send_messages(digest_send_function)
+            recipient_email_param.grant_read(digest_send_function)
+            self.grant_config_read(digest_send_function)
+
+    def create_cph_marathon_scraper(self, common_lambda_layer):
         ticket_topic = self.create_ticket_topic()
+        watch_state_table = self.create_watch_state_table()
         cph_marathon_scraper_function = self.create_cph_marathon_scraper_function(
-            ticket_topic.topic_arn
+            common_lambda_layer, ticket_topic.topic_arn, watch_state_table.table_name
         )
         ticket_event_rule = self.create_ticket_event_rule()
         ticket_event_rule.add_target(LambdaFunction(cph_marathon_scraper_function))
         ticket_topic.grant_publish(cph_marathon_scraper_function)
+        watch_state_table.grant_read_write_data(cph_marathon_scraper_function)
 
     def create_sellpy_table(self) -> TableV2:
         return TableV2(
@@ -121,6 +188,28 @@ class WebScraperStack(Stack):
             ),
         )
 
+    def create_watch_state_table(self) -> TableV2:
+        return TableV2(
+            self,
+            "WatchStateTable",
+            table_name="watch_state",
+            partition_key=Attribute(name="name", type=AttributeType.STRING),
+            billing=Billing.provisioned(
+                read_capacity=Capacity.fixed(1),
+                write_capacity=Capacity.autoscaled(max_capacity=5, seed_capacity=1),
+            ),
+        )
+
+    def create_brand_stats_table(self) -> TableV2:
+        return TableV2(
+            self,
+            "BrandStatsTable",
+            table_name="brand_stats",
+            partition_key=Attribute(name="source", type=AttributeType.STRING),
+            sort_key=Attribute(name="brand", type=AttributeType.STRING),
+            billing=Billing.on_demand(),
+        )
+
     def create_html_bucket(self) -> s3.Bucket:
         return s3.Bucket(
             self,
@@ -141,6 +230,129 @@ class WebScraperStack(Stack):
             ),
         )
 
+    def create_common_lambda_layer(self) -> PythonLayerVersion:
+        return PythonLayerVersion(
+            self,
+            "CommonLayer",
+            entry="./functions/layers/common",
+            compatible_runtimes=[Runtime.PYTHON_3_8, Runtime.PYTHON_3_12],
+        )
+
+    def create_fanout_state_machine(self, name, scraper_function) -> sfn.StateMachine:
+        shard_size = self.node.try_get_context("shard_size") or 8
+        shard_concurrency = self.node.try_get_context("shard_concurrency") or 4
+
+        plan_payload = {"action": "plan", "shard_size": shard_size}
+        if self.is_adaptive_scheduling():
+            # The plan only covers the brands in the tier of the scheduled run
+            plan_payload["tier"] = sfn.JsonPath.string_at("$$.Execution.Input.tier")
+
+        plan = tasks.LambdaInvoke(
+            self,
+            f"{name}PlanShards",
+            lambda_function=scraper_function,
+            payload=sfn.TaskInput.from_object(plan_payload),
+            payload_response_only=True,
+        )
+
+        scrape_shard = tasks.LambdaInvoke(
+            self,
+            f"{name}ScrapeShard",
+            lambda_function=scraper_function,
+            payload=sfn.TaskInput.from_object(
+                {"action": "scrape", "brands": sfn.JsonPath.list_at("$.brands")}
+            ),
+            payload_response_only=True,
+        )
+        # A failed shard only loses its own brands, the rest still get notified
+        scrape_shard.add_catch(
+            sfn.Pass(
+                self,
+                f"{name}ShardFailed",
+                parameters={
+                    "brands.$": "$.brands",
+                    "count": 0,
+                    "error.$": "$.error.Cause",
+                },
+            ),
+            result_path="$.error",
+        )
+
+        shards = sfn.Map(
+            self,
+            f"{name}Shards",
+            items_path="$.shards",
+            max_concurrency=shard_concurrency,
+            result_path="$.results",
+        )
+        shards.item_processor(scrape_shard)
+
+        aggregate = tasks.LambdaInvoke(
+            self,
+            f"{name}Aggregate",
+            lambda_function=scraper_function,
+            payload=sfn.TaskInput.from_object(
+                {
+                    "action": "aggregate",
+                    "results": sfn.JsonPath.list_at("$.results"),
+                    # Trigger time of the schedule, used to pick the digest window
+                    "time": sfn.JsonPath.string_at("$$.Execution.Input.time"),
+                }
+            ),
+            payload_response_only=True,
+        )
+
+        return sfn.StateMachine(
+            self,
+            f"{name}FanoutStateMachine",
+            definition_body=sfn.DefinitionBody.from_chainable(
+                plan.next(shards).next(aggregate)
+            ),
+            timeout=Duration.minutes(30),
+        )
+
+    def get_digest_environment(self) -> dict:
+        return {
+            "DIGEST_MODE": self.node.try_get_context("digest_mode") or "per-source",
+            "DIGEST_WINDOW_MINUTES": str(self.get_digest_window_minutes()),
+        }
+
+    def get_digest_window_minutes(self) -> int:
+        return self.node.try_get_context("digest_window_minutes") or 60
+
+    def create_digest_event_rule(self) -> Rule:
+        if self.is_adaptive_scheduling():
+            # Tiered runs save fragments all day, send each window after it closes
+            return Rule(
+                self,
+                "DigestLambdaEvent",
+                schedule=Schedule.rate(Duration.minutes(self.get_digest_window_minutes())),
+            )
+
+        # Fires when the window opened by the daily scraper run at 04:00 closes
+        closes_at = 4 * 60 + self.get_digest_window_minutes()
+        return Rule(
+            self,
+            "DigestLambdaEvent",
+            schedule=Schedule.cron(
+                hour=str(closes_at // 60 % 24), minute=str(closes_at % 60)
+            ),
+        )
+
+    def is_adaptive_scheduling(self) -> bool:
+        return self.node.try_get_context("scheduling") == "adaptive"
+
+    def create_tier_event_rules(self) -> dict:
+        return {
+            tier: Rule(self, f"{tier.capitalize()}TierLambdaEvent", schedule=schedule)
+            for tier, schedule in SCHEDULE_TIERS.items()
+        }
+
+    def create_tier_event_input(self, tier):
+        if tier is None:
+            return None
+        return RuleTargetInput.from_object({"tier": tier, "time": EventField.time})
+
     def create_daily_event_rule(self) -> Rule:
         return Rule(
             self,
@@ -156,7 +368,13 @@ class WebScraperStack(Stack):
         )
 
     def create_sellpy_scraper_function(
-        self, chrome_driver_layer, topic_arn, table_name, bucket_name, queue_url
+        self,
+        chrome_driver_layer,
+        common_layer,
+        topic_arn,
+        table_name,
+        bucket_name,
+        queue_url,
     ) -> PythonFunction:
         return PythonFunction(
             self,
@@ -165,7 +383,7 @@ class WebScraperStack(Stack):
             runtime=Runtime.PYTHON_3_8,
             handler="lambda_handler",
             entry="./functions/sellpy-scraper",
-            layers=[chrome_driver_layer],
+            layers=[chrome_driver_layer, common_layer],
             memory_size=1024,
             timeout=Duration.minutes(15),
             environment={
@@ -173,11 +391,18 @@ class WebScraperStack(Stack):
                 "DYNAMO_TABLE": table_name,
                 "S3_HTML_BUCKET": bucket_name,
                 "SQS_EMAIL_QUEUE": queue_url,
+                **self.get_digest_environment(),
             },
         )
 
     def create_vinted_web_scraper_function(
-        self, chrome_driver_layer, topic_arn, table_name, bucket_name, queue_url
+        self,
+        chrome_driver_layer,
+        common_layer,
+        topic_arn,
+        table_name,
+        bucket_name,
+        queue_url,
     ) -> PythonFunction:
         return PythonFunction(
             self,
@@ -186,7 +411,7 @@ class WebScraperStack(Stack):
             runtime=Runtime.PYTHON_3_8,
             handler="lambda_handler",
             entry="./functions/vinted-web-scraper",
-            layers=[chrome_driver_layer],
+            layers=[chrome_driver_layer, common_layer],
             memory_size=1024,
             timeout=Duration.minutes(15),
             environment={
@@ -194,11 +419,13 @@ class WebScraperStack(Stack):
                 "DYNAMO_TABLE": table_name,
                 "S3_HTML_BUCKET": bucket_name,
                 "SQS_EMAIL_QUEUE": queue_url,
+                **self.get_digest_environment(),
+                "SCRAPE_MODE": "hybrid",
             },
         )
 
     def create_vinted_api_scraper_function(
-        self, topic_arn, table_name, bucket_name, queue_url
+        self, common_layer, topic_arn, table_name, bucket_name, queue_url
     ) -> PythonFunction:
         return PythonFunction(
             self,
@@ -207,6 +434,7 @@ class WebScraperStack(Stack):
             runtime=Runtime.PYTHON_3_12,
             handler="lambda_handler",
             entry="./functions/vinted-api-scraper",
+            layers=[common_layer],
             memory_size=1024,
             timeout=Duration.minutes(15),
             environment={
@@ -214,10 +442,11 @@ class WebScraperStack(Stack):
                 "DYNAMO_TABLE": table_name,
                 "S3_HTML_BUCKET": bucket_name,
                 "SQS_EMAIL_QUEUE": queue_url,
+                **self.get_digest_environment(),
             },
         )
 
-    def create_email_send_function(self, bucket_name) -> PythonFunction:
+    def create_email_send_function(self, common_layer, bucket_name) -> PythonFunction:
         return PythonFunction(
             self,
             "EmailSendFunction",
@@ -225,14 +454,38 @@ class WebScraperStack(Stack):
             runtime=Runtime.PYTHON_3_12,
             handler="lambda_handler",
             entry="./functions/email-send",
+            layers=[common_layer],
             memory_size=1024,
             timeout=Duration.minutes(1),
             environment={
                 "S3_HTML_BUCKET": bucket_name,
+                "MAX_CONCURRENCY": "4",
+            },
+        )
+
+    def create_digest_send_function(
+        self, common_layer, bucket_name, queue_url
+    ) -> PythonFunction:
+        return PythonFunction(
+            self,
+            "DigestSendFunction",
+            function_name="digest-send",
+            runtime=Runtime.PYTHON_3_12,
+            handler="lambda_handler",
+            entry="./functions/digest-send",
+            layers=[common_layer],
+            memory_size=512,
+            timeout=Duration.minutes(1),
+            environment={
+                "S3_HTML_BUCKET": bucket_name,
+                "SQS_EMAIL_QUEUE": queue_url,
+                "DIGEST_WINDOW_MINUTES": str(self.get_digest_window_minutes()),
             },
         )
 
-    def create_cph_marathon_scraper_function(self, topic_arn) -> PythonFunction:
+    def create_cph_marathon_scraper_function(
+        self, common_layer, topic_arn, state_table_name
+    ) -> PythonFunction:
         return PythonFunction(
             self,
             "CphMarathonFunction",
@@ -240,22 +493,31 @@ class WebScraperStack(Stack):
             runtime=Runtime.PYTHON_3_8,
             handler="lambda_handler",
             entry="./functions/cph-marathon-scraper",
+            layers=[common_layer],
             memory_size=512,
             timeout=Duration.minutes(1),
             environment={
                 "SNS_ARN": topic_arn,
+                "STATE_TABLE": state_table_name,
+                "MAX_CONCURRENCY": "8",
             },
         )
 
     def create_sqs_event_source(self, email_queue) -> SqsEventSource:
-        return SqsEventSource(email_queue, batch_size=1)
+        return SqsEventSource(
+            email_queue,
+            batch_size=10,
+            max_batching_window=Duration.seconds(20),
+            report_batch_item_failures=True,
+        )
 
     def create_email_queue(self) -> sqs.Queue:
         return sqs.Queue(
             self,
             "EmailSendQueue",
             queue_name="email-send-queue",
-            visibility_timeout=Duration.seconds(60),
+            # AWS recommends six times the consumer timeout for Lambda event sources
+            visibility_timeout=Duration.minutes(6),
         )
 
     def get_ssm_params(self) -> Tuple[ssm.StringParameter, ssm.StringParameter]:
@@ -335,8 +597,58 @@ class WebScraperStack(Stack):
         html_bucket.grant_put(vinted_web_scraper_function)
         html_bucket.grant_put(vinted_api_scraper_function)
         html_bucket.grant_put(sellpy_scraper_function)
+        # Replaying captured responses (CAPTURE=replay) reads them back
+        html_bucket.grant_read(vinted_web_scraper_function, "captures/*")
+        html_bucket.grant_read(vinted_api_scraper_function, "captures/*")
+        html_bucket.grant_read(sellpy_scraper_function, "captures/*")
+        # Shard results of the fan-out state machine are handed over in the bucket
+        html_bucket.grant_read(sellpy_scraper_function, "pending/*")
+        html_bucket.grant_read(vinted_api_scraper_function, "pending/*")
+        html_bucket.grant_delete(sellpy_scraper_function, "pending/*")
+        html_bucket.grant_delete(vinted_api_scraper_function, "pending/*")
         html_bucket.grant_read(email_send_function)
+        # Only for the reports of the profiling hook
+        html_bucket.grant_put(email_send_function, "profiles/*")
 
         email_queue.grant_send_messages(vinted_web_scraper_function)
         email_queue.grant_send_messages(vinted_api_scraper_function)
         email_queue.grant_send_messages(sellpy_scraper_function)
+
+        self.grant_config_read(
+            vinted_web_scraper_function,
+            vinted_api_scraper_function,
+            sellpy_scraper_function,
+            email_send_function,
+        )
+
+        # Runs that are about to time out continue in a new invocation
+        self.grant_invoke_self(sellpy_scraper_function, "sellpy-scraper")
+        self.grant_invoke_self(vinted_web_scraper_function, "vinted-web-scraper")
+
+    def grant_invoke_self(self, function, function_name):
+        # From the name, referencing the function in its own role policy is circular
+        function.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["lambda:InvokeFunction"],
+                resources=[
+                    self.format_arn(
+                        service="lambda",
+                        resource="function",
+                        resource_name=function_name,
+                        arn_format=ArnFormat.COLON_RESOURCE_NAME,
+                    )
+                ],
+            )
+        )
+
+    def grant_config_read(self, *functions):
+        config_statement = iam.PolicyStatement(
+            actions=["ssm:GetParametersByPath"],
+            resources=[
+                self.format_arn(service="ssm", resource="parameter", resource_name=name)
+                for path in CONFIG_PATHS
+                for name in (path, f"{path}/*")
+            ],
+        )
+        for function in functions:
+            function.add_to_role_policy(config_statement)
@@ -0,0 +1,2 @@
+"""Runs the scrapers in one long-lived process, see ``python -m daemon --help``."""
+from localrun import COMMON_LAYER_DIR, FUNCTIONS_DIR, ROOT_DIR  # noqa: F401
@@ -0,0 +1,170 @@
+"""Poll the scrapers from one long-lived process instead of Lambda.
+
+    python -m daemon                              # every source at its default interval
+    python -m daemon vinted-api vinted-web        # only these sources
+    python -m daemon --interval vinted-api=120    # poll vinted-api every two minutes
+    python -m daemon --once                       # run every source once and exit
+
+The handlers are loaded once and polled on one asyncio event loop, so HTTP
+connection pools, config and AWS clients stay warm between runs. Sellpy and
+Vinted web share one Chrome, and runs that render pages take turns with it on
+a single worker thread. Vinted web in hybrid mode reads the JSON API and runs
+alongside the other sources. A run that fails quits the browser and reloads
+its source. New
+listings are stored and notified exactly as in Lambda, through DynamoDB and
+the SQS email queue, so email-send and digest-send still have to be deployed.
+"""
+import argparse
+import asyncio
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+# Read by the shared layer when it is imported, so load before importing it
+load_dotenv()
+
+from daemon.sources import SOURCES, Source  # noqa: E402
+from scraper_common import log  # noqa: E402
+
+
+def parse_interval(value: str):
+    name, _, seconds = value.partition("=")
+    try:
+        return name, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected <source>=<seconds>, got {value!r}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m daemon", description=__doc__.split("\n")[0])
+    parser.add_argument("sources", nargs="*", help=f"default: all of {', '.join(SOURCES)}")
+    parser.add_argument(
+        "--interval",
+        type=parse_interval,
+        action="append",
+        default=[],
+        metavar="SOURCE=SECONDS",
+        help="seconds between the starts of a source's runs",
+    )
+    parser.add_argument("--once", action="store_true", help="run each source once and exit")
+    args = parser.parse_args()
+
+    unknown = (set(args.sources) | {name for name, _ in args.interval}) - set(SOURCES)
+    if unknown:
+        parser.error(f"unknown source(s): {', '.join(sorted(unknown))}")
+    args.sources = args.sources or list(SOURCES)
+    return args
+
+
+class Daemon:
+    def __init__(self, sources, once: bool = False):
+        self.sources = sources
+        self.once = once
+        self.browser = None
+        self.failures = 0
+        # One Chrome can only render one page at a time
+        self.browser_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="browser")
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(len(sources), 1), thread_name_prefix="source"
+        )
+        self.stop = None
+
+    def load(self, source: Source):
+        module = source.load()
+        if source.uses_browser:
+            # Sellpy and Vinted web create the same driver, the first one
+            # loaded provides it for both
+            if self.browser is None:
+                self.browser = module.browser
+            module.browser = self.browser
+
+    def get_executor(self, source: Source) -> ThreadPoolExecutor:
+        return self.browser_executor if source.runs_in_browser() else self.executor
+
+    async def run(self) -> int:
+        loop = asyncio.get_running_loop()
+        self.stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop.set)
+
+        for source in self.sources:
+            self.load(source)
+        log.info(
+            "Daemon started",
+            sources={source.name: source.interval for source in self.sources},
+        )
+
+        try:
+            await asyncio.gather(*(self.poll(source) for source in self.sources))
+        finally:
+            log.info("Daemon stopping, waiting for running scrapers")
+            self.executor.shutdown(wait=True)
+            self.browser_executor.shutdown(wait=True)
+            if self.browser is not None:
+                self.browser.quit()
+
+        return 1 if self.failures and self.once else 0
+
+    async def poll(self, source: Source):
+        loop = asyncio.get_running_loop()
+
+        while not self.stop.is_set():
+            started = loop.time()
+            try:
+                # Asked per run, vinted-web only needs the browser thread in browser mode
+                response = await loop.run_in_executor(self.get_executor(source), source.run)
+                log.info(
+                    "Source run finished",
+                    source=source.name,
+                    seconds=round(loop.time() - started, 1),
+                    body=response.get("body") if isinstance(response, dict) else None,
+                )
+            except Exception as e:
+                self.failures += 1
+                log.error("Source run failed", source=source.name, error=repr(e))
+                await self.reset(source)
+
+            if self.once:
+                return
+
+            # Intervals are between starts, a run longer than its interval is
+            # followed by the next one right away
+            delay = max(source.interval - (loop.time() - started), 0)
+            try:
+                await asyncio.wait_for(self.stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def reset(self, source: Source):
+        """Drops the source's sessions and browser, they may be what failed."""
+        loop = asyncio.get_running_loop()
+        if source.uses_browser and self.browser is not None:
+            # On the browser thread, so a run of the other browser source finishes first
+            await loop.run_in_executor(self.browser_executor, self.browser.quit)
+        try:
+            self.load(source)
+        except Exception as e:
+            log.error(
+                "Source reload failed, keeping the loaded one",
+                source=source.name,
+                error=repr(e),
+            )
+
+
+def main() -> int:
+    args = parse_args()
+    intervals = dict(args.interval)
+
+    sources = []
+    for name in args.sources:
+        source = SOURCES[name]
+        source.interval = intervals.get(name, source.interval)
+        sources.append(source)
+
+    return asyncio.run(Daemon(sources, once=args.once).run())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
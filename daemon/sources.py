@@ -0,0 +1,56 @@
+"""The scrapers the daemon polls and how their handlers are loaded and invoked."""
+import sys
+import time
+
+from daemon import COMMON_LAYER_DIR
+from localrun import load_function
+
+sys.path.insert(0, str(COMMON_LAYER_DIR))
+
+
+class Source:
+    """A scraper function, polled every ``interval`` seconds.
+
+    The module is loaded once and kept, so whatever the handler keeps between
+    warm invocations (HTTP sessions, the browser, config and clients) is kept
+    between polls too.
+    """
+
+    def __init__(self, name: str, directory: str, interval: float, uses_browser: bool = False):
+        self.name = name
+        self.directory = directory
+        self.interval = interval
+        self.uses_browser = uses_browser
+        self.module = None
+
+    def runs_in_browser(self) -> bool:
+        """Whether the next run renders pages, those runs take turns on one thread."""
+        return self.uses_browser
+
+    def load(self):
+        self.module = load_function(self.directory, prefix="daemon")
+        return self.module
+
+    def run(self) -> dict:
+        # Same event as the scheduled rule, the time keeps the results in the
+        # right digest window. Without a tier every brand is scraped.
+        event = {"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+        return self.module.lambda_handler(event, None)
+
+
+class VintedWebSource(Source):
+    def runs_in_browser(self) -> bool:
+        # In hybrid mode the browser only bootstraps the API session when plain
+        # HTTP gets no token. A bootstrap while sellpy has the shared driver
+        # gets a driver of its own, see scraper_common.browser.
+        return self.module.get_scrape_mode() == "browser"
+
+
+# Default seconds between polls, cph-marathon checks which of its targets
+# are due itself, like its every minute schedule in AWS
+SOURCES = {
+    "sellpy": Source("sellpy", "sellpy-scraper", 30 * 60, uses_browser=True),
+    "vinted-api": Source("vinted-api", "vinted-api-scraper", 10 * 60),
+    "vinted-web": VintedWebSource("vinted-web", "vinted-web-scraper", 10 * 60, uses_browser=True),
+    "cph-marathon": Source("cph-marathon", "cph-marathon-scraper", 60),
+}
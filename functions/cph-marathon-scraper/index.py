@@ -1,65 +1,188 @@
-import boto3
+import hashlib
+import json
 import os
-import requests
+import time
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from scraper_common import capture
+from scraper_common.clients import get_client
+
+# Each target is a page to watch: url, text rules mapping page content to a
+# status, the statuses to notify on and how often to check it. See targets.json.
+TARGETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'targets.json')
 
-# TICKET_URL_MARATHON = 'https://secure.onreg.com/onreg2/bibexchange/?eventid=6591&language=us'
-TICKET_URL_HALF_MARATHON = 'SET NEW URL'
 SNS_ARN = os.environ['SNS_ARN']
+STATE_TABLE = os.getenv('STATE_TABLE')
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', '8'))
+
+# The schedule fires every minute, allow for a little jitter in the trigger time
+INTERVAL_SLACK_SECONDS = 5
+
+session = capture.session(pool_maxsize=MAX_CONCURRENCY)
+
+# Target state by name, kept across warm invocations. The state table covers
+# cold starts, the time of the last check is only kept in memory.
+states = {}
+checked_at = {}
+
 
 def lambda_handler(event, context):
     print('-----------handler started------------')
-    
-    available_ticket, status = check_tickets()
-    
-    if available_ticket:
-        publish_to_sns('AVAILABLE')
-    
+
+    now = time.time()
+    targets = [target for target in load_targets() if is_due(target, now)]
+    load_states(targets)
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as pool:
+        results = list(pool.map(watch_target, targets))
+
+    statuses = {target['name']: status for target, status in zip(targets, results)}
+    print(f'Checked {len(targets)} target(s): {statuses}')
+
     return {
         'statusCode': 200,
-        'body': f'tickets available: {available_ticket}'
+        'body': json.dumps(statuses)
     }
 
-def check_tickets():
-    response = requests.get(TICKET_URL_HALF_MARATHON)
-    soup = BeautifulSoup(response.text, 'html.parser')
+
+def load_targets():
+    with open(TARGETS_FILE, 'r', encoding='utf-8') as file:
+        targets = json.load(file)
+    return [target for target in targets if target.get('enabled', True)]
+
+
+def is_due(target, now):
+    last_checked = checked_at.get(target['name'])
+    interval = target.get('interval_minutes', 1) * 60
+    return last_checked is None or now - last_checked >= interval - INTERVAL_SLACK_SECONDS
+
+
+def watch_target(target):
+    try:
+        previous_status, status = check_target(target)
+    except Exception as e:
+        # One broken page should not stop the other targets from being checked
+        print(f"Checking {target['name']} failed: {e}")
+        return None
+
+    checked_at[target['name']] = time.time()
+
+    # Only notify on a change into a watched status, not on every poll while it lasts
+    if status != previous_status and status in target.get('notify_on', []):
+        publish_to_sns(target, status)
+
+    return status
+
+
+def check_target(target):
+    previous = dict(states.get(target['name'], {}))
+    headers = {}
+    if previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+    if previous.get('last_modified'):
+        headers['If-Modified-Since'] = previous['last_modified']
+
+    response = session.get(target['url'], headers=headers, timeout=10)
+
+    if response.status_code == 304:
+        print(f"{target['name']}: page not modified")
+        return previous.get('status'), previous.get('status')
+
+    region = extract_region(response.text, target.get('region'))
+    region_hash = hashlib.sha256(region.encode('utf-8')).hexdigest()
+
+    if region_hash == previous.get('region_hash'):
+        print(f"{target['name']}: watched region unchanged")
+        status = previous['status']
+    else:
+        status = parse_status(region, target)
+
+    save_state(target, {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'region_hash': region_hash,
+        'status': status,
+    }, previous)
+
+    return previous.get('status'), status
+
+
+def extract_region(html, region):
+    # Only the part of the page between the markers is hashed and parsed, the
+    # whole page is used if the markers are not configured or have moved
+    if not region:
+        return html
+
+    start = html.find(region['start'])
+    if start == -1:
+        return html
+
+    end = html.find(region['end'], start + len(region['start']))
+    return html[start:end] if end != -1 else html[start:]
+
+
+def parse_status(region, target):
+    page_text = BeautifulSoup(region, 'html.parser').get_text()
 
     # For local test files
     # with open('sample-pending.html', 'r', encoding='utf-8') as file:
-    #     html_content = file.read()
+    #     page_text = BeautifulSoup(file.read(), 'html.parser').get_text()
 
-    # soup = BeautifulSoup(html_content, 'html.parser')
+    for rule in target['rules']:
+        if rule['contains'] in page_text:
+            print(f"{target['name']}: {rule['status']}")
+            return rule['status']
 
-    page_text = soup.get_text()
+    print(f"{target['name']}: no rule matched, {target['default_status']}")
+    return target['default_status']
 
-    if "There are currently no race numbers for sale" in page_text:
-        print("No tickets available")
-        return False, False 
-    if "In progress" in page_text:
-        print("Ticket in progress")
-        return False, True
 
-    print("Text not found the page. Tickets available!")
-    print(page_text)
-    return True, True
+def load_states(targets):
+    names = [target['name'] for target in targets if target['name'] not in states]
+    if not names or not STATE_TABLE:
+        return
 
-def publish_to_sns(status):
-    client = boto3.client('sns')
-    
-    subject = f'TICKETS {status}'
-    message = f'Tickets are {status.lower()}.\nCheck the link: {TICKET_URL_HALF_MARATHON}'
+    response = get_client('dynamodb').batch_get_item(
+        RequestItems={
+            STATE_TABLE: {'Keys': [{'name': {'S': name}} for name in names]}
+        }
+    )
+    for item in response['Responses'].get(STATE_TABLE, []):
+        states[item['name']['S']] = {
+            key: value['S'] for key, value in item.items() if key != 'name'
+        }
+
+
+def save_state(target, new_state, previous):
+    new_state = {key: value for key, value in new_state.items() if value}
+    states[target['name']] = new_state
+
+    if not STATE_TABLE or new_state == previous:
+        return
+
+    item = {key: {'S': value} for key, value in new_state.items()}
+    item['name'] = {'S': target['name']}
+    get_client('dynamodb').put_item(TableName=STATE_TABLE, Item=item)
+
+
+def publish_to_sns(target, status):
+    client = get_client('sns')
+
+    subject = f"{target['name']}: {status}"
+    message = f"{target['name']} is {status.lower()}.\nCheck the link: {target['url']}"
 
     response = client.publish(
-        TopicArn= SNS_ARN,
+        TopicArn=target.get('topic_arn', SNS_ARN),
         Message=message,
         Subject=subject
     )
 
     print('-------------------------')
     print("Message published to SNS:", response['MessageId'])
-            
+
+
 if __name__ == '__main__':
     event = {}  # Provide any necessary event data here
     context = {}  # Provide any necessary context data here
     result = lambda_handler(event, context)
-    print(result)
\ No newline at end of file
+    print(result)
@@ -0,0 +1,23 @@
+import json
+from dotenv import load_dotenv
+from scraper_common import log, metrics
+from scraper_common.digest import send_combined_digest
+from scraper_common.profiling import profiled
+
+
+@profiled("digest-send")
+@metrics.instrumented("digest-send")
+def lambda_handler(event, context):
+    log.info("Handler started")
+
+    nbr_of_listings = send_combined_digest(event.get("time"))
+
+    return {"statusCode": 200, "body": json.dumps(nbr_of_listings)}
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    event = {}  # Provide any necessary event data here
+    context = {}  # Provide any necessary context data here
+    result = lambda_handler(event, context)
+    print(result)
@@ -1,37 +1,87 @@
+import contextvars
 import json
-import boto3
 import os
-
-s3 = boto3.client("s3")
-ses = boto3.client("ses")
-ssm = boto3.client("ssm")
+import time
+from concurrent.futures import ThreadPoolExecutor
+from scraper_common import config, log, metrics, tracing
+from scraper_common.clients import get_client
+from scraper_common.notify import read_html
+from scraper_common.profiling import profiled
 
 BUCKET_NAME = os.environ["S3_HTML_BUCKET"]
-SENDER_EMAIL = ssm.get_parameter(Name="/ses/email/sender")["Parameter"]["Value"]
 
+# Upper bound on S3 reads and SES sends in flight for one batch
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "4"))
+
+
+@profiled("email-send")
+@metrics.instrumented("email-send")
 def lambda_handler(event, context):
-    print(event)
-    for record in event["Records"]:
+    records = event["Records"]
+    log.info("Received batch", messages=len(records))
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as pool:
+        # Each in a copy of this context, so their metrics and logs count for this invocation
+        futures = [
+            pool.submit(contextvars.copy_context().run, process_record, record)
+            for record in records
+        ]
+        results = [future.result() for future in futures]
+
+    # Only the failed messages return to the queue, the rest of the batch is deleted
+    failures = [
+        {"itemIdentifier": record["messageId"]}
+        for record, sent in zip(records, results)
+        if not sent
+    ]
+    log.info("Batch sent", sent=len(records) - len(failures), failed=len(failures))
+    metrics.add("send.items_in", len(records))
+    metrics.add("send.failures", len(failures))
+
+    return {"batchItemFailures": failures}
+
+
+def process_record(record) -> bool:
+    try:
         body = json.loads(record["body"])
-        
-        sender_name = body["sender_name"]
-        subject = body["subject"]
-        recipient = body["recipient"]
-        object_key = body["object_key"]
-        
-        # Get HTML content from S3
-        response = s3.get_object(Bucket=BUCKET_NAME, Key=object_key)
-        html_content = response["Body"].read().decode("utf-8")
-        
-        response = ses.send_email(
-            Source=f"{sender_name} <{SENDER_EMAIL}>",
+
+        # Continues the trace of the scraper run that queued the message
+        parent = tracing.extract(body)
+        with tracing.span("email.send", parent=parent, message_id=record["messageId"]):
+            send_email(body)
+
+        if parent is not None:
+            record_scrape_to_send(parent)
+        return True
+    except Exception as e:
+        log.error("Failed to send message", message_id=record["messageId"], error=str(e))
+        return False
+
+
+def record_scrape_to_send(parent: tracing.SpanContext):
+    latency_ms = (time.time() - parent.trace_started_at) * 1000
+    metrics.observe("scrape_to_send.latency", latency_ms)
+    log.info("Scrape to send", trace_id=parent.trace_id, seconds=round(latency_ms / 1000, 1))
+
+
+def send_email(body):
+    sender_name = body["sender_name"]
+    subject = body["subject"]
+    recipient = body["recipient"]
+    sender_email = config.get_parameter(config.SENDER_PARAMETER)
+
+    # Small digests are inlined in the message, larger ones are read from S3
+    with metrics.stage("read"):
+        html_content = read_html(body, get_client("s3"), BUCKET_NAME)
+    metrics.add("read.bytes", len(html_content.encode("utf-8")), metrics.BYTES)
+
+    with metrics.stage("send"):
+        response = get_client("ses").send_email(
+            Source=f"{sender_name} <{sender_email}>",
             Destination={"ToAddresses": [recipient]},
             Message={
                 "Subject": {"Data": subject},
                 "Body": {"Html": {"Data": html_content}}
             },
         )
-        print("Message published to SES:", response["MessageId"])
-        
-        
-    return {"statusCode": 200, "body": "Emails sent successfully"}
\ No newline at end of file
+    log.info("Message published to SES", message_id=response["MessageId"])
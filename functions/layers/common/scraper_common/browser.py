@@ -0,0 +1,67 @@
+"""A webdriver that is kept between runs.
+
+Starting Chrome takes seconds, so a scraper creates its driver on first use
+and later runs in the same process, warm Lambda invocations or the daemon,
+reuse it. A driver that no longer responds, e.g. after the browser crashed,
+is quit and replaced on the next ``use()``.
+
+One run at a time has the warm driver. A run that starts while it is taken,
+e.g. a concurrent shard of a local fan-out, gets a driver of its own that is
+quit when the run ends.
+"""
+import threading
+from contextlib import contextmanager
+
+from scraper_common import log
+
+
+class WarmDriver:
+    def __init__(self, create):
+        self._create = create
+        self._driver = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def use(self):
+        if not self._lock.acquire(blocking=False):
+            driver = self._create()
+            try:
+                yield driver
+            finally:
+                quit_driver(driver)
+            return
+
+        try:
+            if self._driver is not None and not is_alive(self._driver):
+                log.info("Browser stopped responding, starting a new one")
+                self._quit()
+            if self._driver is None:
+                self._driver = self._create()
+            yield self._driver
+        finally:
+            self._lock.release()
+
+    def quit(self):
+        """Quits the warm driver, waits for the run using it to finish."""
+        with self._lock:
+            self._quit()
+
+    def _quit(self):
+        driver, self._driver = self._driver, None
+        if driver is not None:
+            quit_driver(driver)
+
+
+def is_alive(driver) -> bool:
+    try:
+        driver.current_url
+        return True
+    except Exception:
+        return False
+
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except Exception as e:
+        log.warning("Failed to quit browser", error=str(e))
@@ -0,0 +1,110 @@
+"""Fit a scraper run into the time the Lambda invocation has left.
+
+``Budget.brands()`` hands out brands in priority order, most new listings
+per day first, as long as the remaining time minus RESERVE_MS (kept for
+saving and notifying) covers the brand's estimated cost. The estimate is the
+brand's fetch latency from scraper_common.schedule, otherwise the average of
+the brands scraped so far in this run, otherwise ``default_cost_ms``.
+
+The brands that did not fit are left in ``skipped``. The handler saves each
+brand as it finishes, notifies what it has at the end and ``continue_with()``
+invokes the function again, asynchronously, with only the rest, so a slow
+run ends with partial results instead of timing out with none. At least
+one brand is scraped per invocation, and a chain stops after
+MAX_CONTINUATIONS.
+
+Without a Lambda context (e.g. when running locally) there is no deadline.
+"""
+import json
+import os
+import time
+from typing import Iterator, List, Optional
+
+from scraper_common import log, metrics, schedule
+from scraper_common.clients import get_client
+
+RESERVE_MS = int(os.getenv("BUDGET_RESERVE_MS", "60000"))
+MAX_CONTINUATIONS = int(os.getenv("BUDGET_MAX_CONTINUATIONS", "3"))
+
+
+class Budget:
+    def __init__(self, context, source: str, default_cost_ms: float):
+        self.source = source
+        self.default_cost_ms = default_cost_ms
+        self.skipped: List[str] = []
+        self._context = context
+        self._get_remaining_ms = getattr(context, "get_remaining_time_in_millis", None)
+        self._stats = schedule.load_stats(source)
+        self._spent_ms: List[float] = []
+
+    def remaining_ms(self) -> Optional[float]:
+        if self._get_remaining_ms is None:
+            return None
+        return self._get_remaining_ms() - RESERVE_MS
+
+    def is_exhausted(self) -> bool:
+        remaining = self.remaining_ms()
+        return remaining is not None and remaining <= 0
+
+    def estimate_ms(self, brand: str) -> float:
+        stats = self._stats.get(brand)
+        if stats is not None and stats.latency_ms:
+            return stats.latency_ms
+        if self._spent_ms:
+            return sum(self._spent_ms) / len(self._spent_ms)
+        return self.default_cost_ms
+
+    def order(self, brands: List[str]) -> List[str]:
+        def priority(brand):
+            # Brands without stats go first, their yield is unknown
+            stats = self._stats.get(brand)
+            return -stats.daily_rate if stats is not None else float("-inf")
+
+        return sorted(brands, key=priority)
+
+    def brands(self, brands: List[str]) -> Iterator[str]:
+        """Yields brands while there is time for them, the rest end up in ``skipped``."""
+        ordered = self.order(brands)
+        for index, brand in enumerate(ordered):
+            remaining = self.remaining_ms()
+            if index > 0 and remaining is not None and remaining < self.estimate_ms(brand):
+                self.skipped = ordered[index:]
+                log.warning(
+                    "Out of time, leaving brands for a continuation",
+                    remaining_ms=round(remaining),
+                    scraped=index,
+                    skipped=len(self.skipped),
+                )
+                metrics.add("budget.skipped_brands", len(self.skipped))
+                return
+
+            started = time.perf_counter()
+            yield brand
+            self._spent_ms.append((time.perf_counter() - started) * 1000)
+
+    def continue_with(self, event: dict):
+        """Invokes this function again with the skipped brands."""
+        if not self.skipped:
+            return
+
+        continuation = event.get("continuation", 0) + 1
+        if continuation > MAX_CONTINUATIONS:
+            log.error("Continuation limit reached, brands not scraped", brands=self.skipped)
+            return
+
+        payload = {"brands": self.skipped, "continuation": continuation}
+        if event.get("time"):
+            # Keeps the continuation's results in the digest window of the run
+            payload["time"] = event["time"]
+
+        response = get_client("lambda").invoke(
+            FunctionName=self._context.function_name,
+            InvocationType="Event",
+            Payload=json.dumps(payload).encode("utf-8"),
+        )
+        log.info(
+            "Continuation invoked",
+            continuation=continuation,
+            brands=len(self.skipped),
+            status=response["StatusCode"],
+        )
@@ -0,0 +1,313 @@
+"""Record and replay of marketplace responses.
+
+With ``CAPTURE=record`` every HTTP response the scrapers receive through a
+session from ``session()``/``mount()`` and every page source read from a
+driver made by ``driver()`` is saved. With ``CAPTURE=replay`` the same
+calls are answered from the saved captures without touching the network or
+starting Chrome, so parsing and the rest of the pipeline can be run and
+benchmarked against real, current responses.
+
+Bodies are stored gzipped and content addressed (``blobs/<sha256>.gz``), so
+an unchanged page is stored once however often it is captured. Each request
+gets a small JSON record with its metadata and the digest of its body,
+named after a hash of the request so replay can look it up directly. The
+latest capture of a request wins.
+
+Captures go to CAPTURE_DIR when it is set (or ``captures`` when
+``ENVIRONMENT=local``), otherwise under ``captures/`` in the S3_HTML_BUCKET
+bucket.
+"""
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+import requests
+from botocore.exceptions import ClientError
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.cookies import extract_cookies_to_jar
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from scraper_common.clients import get_client
+
+RECORD = "record"
+REPLAY = "replay"
+
+S3_PREFIX = "captures/"
+
+# Describe the bytes on the wire, not the decoded body that is stored
+SKIPPED_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+
+def get_mode() -> Optional[str]:
+    mode = os.getenv("CAPTURE", "").lower()
+    return mode if mode in (RECORD, REPLAY) else None
+
+
+def request_key(kind: str, identifier: str) -> str:
+    return hashlib.sha256(f"{kind}\n{identifier}".encode("utf-8")).hexdigest()
+
+
+class Store:
+    """Blobs and records on disk or in S3."""
+
+    def __init__(self):
+        directory = os.getenv("CAPTURE_DIR")
+        if directory is None and os.getenv("ENVIRONMENT") == "local":
+            directory = "captures"
+        self.directory = directory
+        self._written = set()
+        self._lock = threading.Lock()
+
+    def put_blob(self, body: bytes) -> str:
+        digest = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            if digest in self._written:
+                return digest
+            self._written.add(digest)
+        self._write(f"blobs/{digest}.gz", gzip.compress(body))
+        return digest
+
+    def get_blob(self, digest: str) -> bytes:
+        return gzip.decompress(self._read(f"blobs/{digest}.gz"))
+
+    def put_record(self, kind: str, identifier: str, record: dict):
+        record = {
+            "kind": kind,
+            "id": identifier,
+            "captured_at": datetime.now(timezone.utc).isoformat(),
+            **record,
+        }
+        name = f"records/{request_key(kind, identifier)}.json"
+        self._write(name, json.dumps(record).encode("utf-8"))
+
+    def get_record(self, kind: str, identifier: str) -> Optional[dict]:
+        try:
+            return json.loads(self._read(f"records/{request_key(kind, identifier)}.json"))
+        except FileNotFoundError:
+            return None
+
+    def _write(self, name: str, data: bytes):
+        if self.directory is not None:
+            path = os.path.join(self.directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as file:
+                file.write(data)
+        else:
+            get_client("s3").put_object(
+                Bucket=os.environ["S3_HTML_BUCKET"], Key=S3_PREFIX + name, Body=data
+            )
+
+    def _read(self, name: str) -> bytes:
+        if self.directory is not None:
+            with open(os.path.join(self.directory, name), "rb") as file:
+                return file.read()
+        try:
+            response = get_client("s3").get_object(
+                Bucket=os.environ["S3_HTML_BUCKET"], Key=S3_PREFIX + name
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                raise FileNotFoundError(name) from e
+            raise
+        return response["Body"].read()
+
+
+_store = None
+
+
+def get_store() -> Store:
+    global _store
+    if _store is None:
+        _store = Store()
+    return _store
+
+
+class RecordingAdapter(HTTPAdapter):
+    def send(self, request, **kwargs):
+        started = time.perf_counter()
+        response = super().send(request, **kwargs)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        original = getattr(response.raw, "_original_response", None)
+        # The raw message keeps repeated headers such as Set-Cookie apart
+        if original is not None:
+            headers = list(original.msg.items())
+        else:
+            headers = list(response.headers.items())
+
+        get_store().put_record(
+            "http",
+            f"{request.method} {request.url}",
+            {
+                "status": response.status_code,
+                "reason": response.reason,
+                "headers": headers,
+                "body": get_store().put_blob(response.content),
+                "bytes": len(response.content),
+                "elapsed_ms": round(elapsed_ms, 1),
+            },
+        )
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    def send(self, request, **kwargs):
+        record = get_store().get_record("http", f"{request.method} {request.url}")
+        if record is None:
+            raise requests.ConnectionError(
+                f"No capture for {request.method} {request.url}", request=request
+            )
+
+        message = http.client.HTTPMessage()
+        for name, value in record["headers"]:
+            if name.lower() not in SKIPPED_HEADERS:
+                message[name] = value
+
+        response = requests.Response()
+        response.status_code = record["status"]
+        response.reason = record["reason"]
+        response.headers = CaseInsensitiveDict(message.items())
+        response.url = request.url
+        response.request = request
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = get_store().get_blob(record["body"])
+        response._content_consumed = True
+        # Lets the session pick up Set-Cookie headers as from a real response
+        response.raw = _RawResponse(message)
+        extract_cookies_to_jar(response.cookies, request, response.raw)
+        return response
+
+    def close(self):
+        pass
+
+
+class _RawResponse:
+    def __init__(self, message: http.client.HTTPMessage):
+        self._original_response = _OriginalResponse(message)
+
+    def release_conn(self):
+        pass
+
+
+class _OriginalResponse:
+    def __init__(self, message: http.client.HTTPMessage):
+        self.msg = message
+
+
+def create_adapter(**adapter_kwargs) -> BaseAdapter:
+    mode = get_mode()
+    if mode == REPLAY:
+        return ReplayAdapter()
+    if mode == RECORD:
+        return RecordingAdapter(**adapter_kwargs)
+    return HTTPAdapter(**adapter_kwargs)
+
+
+def mount(session: requests.Session, **adapter_kwargs) -> requests.Session:
+    """Mounts an adapter for the capture mode, ``adapter_kwargs`` go to HTTPAdapter."""
+    adapter = create_adapter(**adapter_kwargs)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def session(**adapter_kwargs) -> requests.Session:
+    return mount(requests.Session(), **adapter_kwargs)
+
+
+class RecordingDriver:
+    """Wraps a webdriver and saves the page sources, cookies and script results it returns.
+
+    Page sources are keyed by the url of the last ``get`` and how many times
+    the source was read since, so pages that load more results on the same
+    url replay in order.
+    """
+
+    def __init__(self, driver):
+        self._driver = driver
+        self._url = None
+        self._reads = 0
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+    def get(self, url):
+        self._url = url
+        self._reads = 0
+        self._driver.get(url)
+
+    @property
+    def page_source(self):
+        source = self._driver.page_source
+        body = source.encode("utf-8")
+        get_store().put_record(
+            "page",
+            f"{self._url}#{self._reads}",
+            {"body": get_store().put_blob(body), "bytes": len(body)},
+        )
+        self._reads += 1
+        return source
+
+    def get_cookies(self):
+        cookies = self._driver.get_cookies()
+        get_store().put_record("cookies", self._url, {"cookies": cookies})
+        return cookies
+
+    def execute_script(self, script, *args):
+        result = self._driver.execute_script(script, *args)
+        if result is not None:
+            get_store().put_record("script", f"{self._url}#{script}", {"result": result})
+        return result
+
+
+class ReplayDriver:
+    """Serves what a RecordingDriver saved, without starting a browser."""
+
+    def __init__(self):
+        self._url = None
+        self._reads = 0
+
+    def get(self, url):
+        self._url = url
+        self._reads = 0
+
+    @property
+    def current_url(self):
+        # Read by scraper_common.browser to tell that the driver is alive
+        return self._url
+
+    @property
+    def page_source(self):
+        record = get_store().get_record("page", f"{self._url}#{self._reads}")
+        if record is None:
+            raise RuntimeError(f"No captured page source {self._reads} for {self._url}")
+        self._reads += 1
+        return get_store().get_blob(record["body"]).decode("utf-8")
+
+    def get_cookies(self):
+        record = get_store().get_record("cookies", self._url)
+        return record["cookies"] if record else []
+
+    def execute_script(self, script, *args):
+        record = get_store().get_record("script", f"{self._url}#{script}")
+        return record["result"] if record else None
+
+    def quit(self):
+        pass
+
+
+def driver(create):
+    """Returns a driver for the capture mode, ``create`` makes the real browser."""
+    mode = get_mode()
+    if mode == REPLAY:
+        return ReplayDriver()
+    if mode == RECORD:
+        return RecordingDriver(create())
+    return create()
@@ -0,0 +1,55 @@
+"""boto3 clients shared by everything running in one Lambda container.
+
+Building a client takes tens of milliseconds and opens its own connection
+pool, so each service gets a single client, created on first use with a
+tuned botocore config. The cost of importing boto3 and of building each
+client is logged, so it shows up in the cold start logs.
+"""
+import os
+import threading
+import time
+
+from scraper_common import log
+
+_import_started = time.perf_counter()
+import boto3  # noqa: E402
+from botocore.config import Config  # noqa: E402
+
+BOTO3_IMPORT_MS = (time.perf_counter() - _import_started) * 1000
+log.info("Imported boto3", ms=round(BOTO3_IMPORT_MS, 1))
+
+CLIENT_CONFIG = Config(
+    # Enough for the thread pools used in email-send and the config refresh
+    max_pool_connections=int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "16")),
+    retries={"mode": "standard", "max_attempts": 5},
+    connect_timeout=3,
+    read_timeout=10,
+)
+
+_clients = {}
+_lock = threading.Lock()
+
+# Milliseconds spent building each client in this container
+client_init_ms = {}
+
+
+def get_client(service_name: str):
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+
+    # boto3's default session is not safe for concurrent client creation
+    with _lock:
+        client = _clients.get(service_name)
+        if client is None:
+            started = time.perf_counter()
+            client = boto3.client(service_name, config=CLIENT_CONFIG)
+            client_init_ms[service_name] = (time.perf_counter() - started) * 1000
+            log.info(
+                "Created client",
+                service=service_name,
+                ms=round(client_init_ms[service_name], 1),
+            )
+            _clients[service_name] = client
+
+    return client
@@ -0,0 +1,126 @@
+"""Cached SSM configuration shared by all functions.
+
+Every parameter below the paths in CONFIG_PATHS is loaded with one
+GetParametersByPath call per path and kept in memory across warm
+invocations. Lookups never wait for SSM once the cache is filled: when the
+cache is older than half of CONFIG_TTL_SECONDS it is refreshed on a
+background thread, and only a cache older than the full TTL is reloaded in
+line.
+
+Brand lists live under /serverless-scraper/brands/<source> as StringList
+parameters, so they can be changed without a redeploy::
+
+    aws ssm put-parameter --type StringList --overwrite \\
+        --name /serverless-scraper/brands/sellpy --value "fedeli,kiton"
+
+Structured settings, such as the listing filters, are JSON String
+parameters read with ``get_json``.
+"""
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from scraper_common import log
+from scraper_common.clients import get_client
+
+DEFAULT_PATHS = "/ses/email,/serverless-scraper"
+BRANDS_PARAMETER = "/serverless-scraper/brands/{}"
+
+RECIPIENT_PARAMETER = "/ses/email/recipient"
+SENDER_PARAMETER = "/ses/email/sender"
+
+TTL_SECONDS = int(os.getenv("CONFIG_TTL_SECONDS", "300"))
+
+_parameters: Dict[str, str] = {}
+_loaded_at = 0.0
+_refreshing = False
+_lock = threading.Lock()
+_lists: Dict[str, tuple] = {}
+_documents: Dict[str, tuple] = {}
+
+
+def get_parameter(name: str, default: Optional[str] = None) -> Optional[str]:
+    return _get_parameters().get(name, default)
+
+
+def get_list(name: str, default: List[str]) -> List[str]:
+    value = get_parameter(name)
+    if value is None:
+        return default
+
+    # Parsed lists are kept until the parameter value changes
+    cached = _lists.get(name)
+    if cached is None or cached[0] != value:
+        cached = (value, [item.strip() for item in value.split(",") if item.strip()])
+        _lists[name] = cached
+    return cached[1]
+
+
+def get_json(name: str, default):
+    value = get_parameter(name)
+    if value is None:
+        return default
+
+    # Parsed documents are kept until the parameter value changes
+    cached = _documents.get(name)
+    if cached is None or cached[0] != value:
+        cached = (value, json.loads(value))
+        _documents[name] = cached
+    return cached[1]
+
+
+def get_brands(source: str, default: List[str]) -> List[str]:
+    return get_list(BRANDS_PARAMETER.format(source), default)
+
+
+def _get_parameters() -> Dict[str, str]:
+    age = time.monotonic() - _loaded_at
+
+    if not _loaded_at or age > TTL_SECONDS:
+        with _lock:
+            if not _loaded_at or time.monotonic() - _loaded_at > TTL_SECONDS:
+                _load()
+    elif age > TTL_SECONDS / 2:
+        _refresh_in_background()
+
+    return _parameters
+
+
+def _refresh_in_background():
+    global _refreshing
+
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+
+    def refresh():
+        global _refreshing
+        try:
+            _load()
+        except Exception as e:
+            # Keep serving the cached values, the next lookup tries again
+            log.warning("Config refresh failed", error=str(e))
+        finally:
+            _refreshing = False
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def _load():
+    global _parameters, _loaded_at
+
+    ssm = get_client("ssm")
+    paginator = ssm.get_paginator("get_parameters_by_path")
+    parameters = {}
+
+    for path in os.getenv("CONFIG_PATHS", DEFAULT_PATHS).split(","):
+        for page in paginator.paginate(Path=path, Recursive=True, WithDecryption=True):
+            for parameter in page["Parameters"]:
+                parameters[parameter["Name"]] = parameter["Value"]
+
+    _parameters = parameters
+    _loaded_at = time.monotonic()
+    log.info("Loaded config parameters", count=len(parameters))
@@ -0,0 +1,150 @@
+"""Combine the results of several scrapers into one digest per schedule window.
+
+With DIGEST_MODE=combined each scraper stores its new listings as a fragment
+of pre-rendered cards, keyed by listing id, under the schedule window it was
+triggered in. The digest-send function runs when the window closes, joins
+all fragments of closed windows into one page render and queues one email.
+"""
+import json
+import os
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional
+
+from scraper_common import log, metrics, notify, tracing
+from scraper_common.clients import get_client
+from scraper_common.listing import Listing
+from scraper_common.render import MAX_EMAIL_BYTES, CardTemplate, render_pages
+
+FRAGMENT_PREFIX = "fragments/"
+WINDOW_FORMAT = "%Y-%m-%dT%H:%M"
+DEFAULT_WINDOW_MINUTES = 60
+
+
+def is_combined_digest() -> bool:
+    return os.getenv("DIGEST_MODE") == "combined"
+
+
+def get_window_minutes() -> int:
+    return int(os.getenv("DIGEST_WINDOW_MINUTES", DEFAULT_WINDOW_MINUTES))
+
+
+def parse_event_time(event_time: Optional[str]) -> datetime:
+    # Scheduled EventBridge events carry their trigger time, e.g. "2025-06-28T04:00:00Z"
+    if event_time:
+        return datetime.strptime(event_time, "%Y-%m-%dT%H:%M:%SZ").replace(
+            tzinfo=timezone.utc
+        )
+    return datetime.now(timezone.utc)
+
+
+def get_window_start(moment: datetime) -> datetime:
+    minutes = get_window_minutes()
+    since_midnight = moment.hour * 60 + moment.minute
+    start = since_midnight - since_midnight % minutes
+    return moment.replace(hour=start // 60, minute=start % 60, second=0, microsecond=0)
+
+
+def save_fragment(
+    source: str,
+    listings: Iterable[Listing],
+    card: CardTemplate,
+    event_time: Optional[str] = None,
+) -> str:
+    window = get_window_start(parse_event_time(event_time)).strftime(WINDOW_FORMAT)
+    fragment = {
+        "source": source,
+        "cards": {
+            listing.id: {"brand": listing.brand, "html": card.render(listing)}
+            for listing in listings
+        },
+    }
+    # Lets the digest report the time from scrape to send of its oldest fragment
+    tracing.inject(fragment)
+
+    bucket_name = os.environ["S3_HTML_BUCKET"]
+    object_key = f"{FRAGMENT_PREFIX}{window}/{source.lower()}-{uuid.uuid4()}.json"
+
+    s3 = get_client("s3")
+    with tracing.span("s3.upload", key=object_key):
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=object_key,
+            Body=json.dumps(fragment),
+            ContentType="application/json",
+        )
+
+    log.info("Saved digest fragment", cards=len(fragment["cards"]), key=object_key)
+    return object_key
+
+
+def send_combined_digest(event_time: Optional[str] = None) -> int:
+    """Queue one digest for all fragments of closed windows and delete them."""
+    now = parse_event_time(event_time)
+    window_length = timedelta(minutes=get_window_minutes())
+    bucket_name = os.environ["S3_HTML_BUCKET"]
+    s3 = get_client("s3")
+
+    keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=FRAGMENT_PREFIX):
+        for item in page.get("Contents", []):
+            window = item["Key"][len(FRAGMENT_PREFIX) :].split("/", 1)[0]
+            window_start = datetime.strptime(window, WINDOW_FORMAT).replace(
+                tzinfo=timezone.utc
+            )
+            if window_start + window_length <= now:
+                keys.append(item["Key"])
+
+    sources = set()
+    cards = {}
+    fragment_traces = []
+    for key in keys:
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+        fragment = json.loads(response["Body"].read())
+        sources.add(fragment["source"])
+        trace = tracing.extract(fragment)
+        if trace is not None:
+            fragment_traces.append(trace)
+        # Keyed by listing id, a listing reported by two fragments is sent once
+        cards.update(fragment["cards"])
+
+    log.info("Combining digest fragments", listings=len(cards), fragments=len(keys))
+    link_fragment_traces(fragment_traces)
+    metrics.add("fragments", len(keys))
+    metrics.add("listings", len(cards))
+
+    if cards:
+        cards_by_brand = defaultdict(list)
+        for card in cards.values():
+            cards_by_brand[card["brand"]].append(card["html"])
+
+        with metrics.stage("render"):
+            pages = render_pages(cards_by_brand, MAX_EMAIL_BYTES)
+        sender_name = " & ".join(sorted(sources))
+        with metrics.stage("notify"):
+            notify.queue_digest(pages, sender_name, f"⚡ {len(cards)} new listings", "digest")
+
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(
+            Bucket=bucket_name,
+            Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]},
+        )
+
+    return len(cards)
+
+
+def link_fragment_traces(fragment_traces: List[tracing.SpanContext]):
+    """Records the traces of the scraper runs that are combined in this digest.
+
+    The digest is a new trace, but it starts the scrape to send clock at the
+    oldest of the combined runs, so email-send measures from the first scrape.
+    """
+    active = tracing.current_span()
+    if active is None or not fragment_traces:
+        return
+
+    active.set_attribute("links", [trace.trace_id for trace in fragment_traces])
+    active.trace_started_at = min(trace.trace_started_at for trace in fragment_traces)
+
@@ -0,0 +1,98 @@
+"""Split a scraper run into brand shards that can run in parallel.
+
+In AWS the shards are run by the Step Functions map state created in
+cdk/web_scraper_stack.py. run_locally plays the same role with a thread pool,
+so the plan/scrape/aggregate actions of a handler can be tried end to end.
+A state is limited to 256 KB, which the new listings of a first run easily
+exceed, so a shard only passes on the keys of the scraper_common.pending
+objects its listings are in and a count.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from scraper_common import log, schedule
+from scraper_common.listing import Listing
+from scraper_common.pending import Pending
+
+DEFAULT_SHARD_SIZE = 8
+
+
+def get_shard_size(event: dict) -> int:
+    return int(event.get("shard_size") or os.getenv("SHARD_SIZE") or DEFAULT_SHARD_SIZE)
+
+
+def split_into_shards(brands: list, shard_size: int) -> dict:
+    return {
+        "shards": [
+            {"brands": brands[i : i + shard_size]}
+            for i in range(0, len(brands), shard_size)
+        ]
+    }
+
+
+def dispatch(
+    event: dict,
+    source: str,
+    select: Callable[[dict], List[str]],
+    scrape: Callable[[List[str], Pending], None],
+    notify: Callable[[List[Listing]], None],
+) -> dict:
+    """Runs the fan-out action of ``event``, or a whole run for an event without one.
+
+    "plan" splits the brands ``select`` picks into shards, "scrape" runs one
+    shard and "aggregate" notifies the new listings of all shards at once.
+    ``scrape`` adds the new listings it stored to the Pending it is given,
+    ``notify`` sends them, also when ``scrape`` fails after storing some.
+    The brand stats of scraper_common.schedule are saved once at the end.
+    """
+    action = event.get("action")
+    if action == "plan":
+        return split_into_shards(select(event), get_shard_size(event))
+
+    pending = Pending(source)
+    if action == "aggregate":
+        for result in event["results"]:
+            if result.get("error"):
+                log.error("Shard failed", brands=result["brands"], error=result["error"])
+            pending.adopt(result.get("keys", []))
+    else:
+        brands = event["brands"] if action == "scrape" else select(event)
+        try:
+            scrape(brands, pending)
+        except Exception:
+            # A stored listing is never new again, so the brands finished
+            # before the failure are sent now or not at all
+            log.warning(
+                "Scrape failed, sending the listings stored so far",
+                count=len(pending.listings),
+            )
+            notify(pending.listings)
+            raise
+        finally:
+            # Once per run, for every brand the run observed
+            schedule.save(source, pending.listings)
+        if action == "scrape":
+            # The aggregate step notifies them with those of the other shards
+            return {"brands": brands, "count": len(pending.listings), "keys": pending.save()}
+
+    notify(pending.listings)
+    pending.clear()
+    return {"statusCode": 200, "body": json.dumps(len(pending.listings))}
+
+
+def run_locally(handler, event: dict, max_concurrency: int = 4) -> dict:
+    plan = handler({**event, "action": "plan"}, None)
+
+    def run_shard(shard):
+        try:
+            return handler({**event, **shard, "action": "scrape"}, None)
+        except Exception as e:
+            # Mirrors the catch on the map state, a failed shard only loses its own brands
+            return {"brands": shard["brands"], "count": 0, "error": repr(e)}
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        results = list(pool.map(run_shard, plan["shards"]))
+
+    return handler({**event, "action": "aggregate", "results": results}, None)
@@ -0,0 +1,191 @@
+"""Per-brand listing filters, pushed into the marketplace search where possible.
+
+Filters are set per source as a JSON parameter under
+/serverless-scraper/filters/<source>, keyed by brand as written in the brand
+list, with ``"*"`` for every brand. A brand's own entry overrides the keys
+it sets::
+
+    aws ssm put-parameter --type String --overwrite \\
+        --name /serverless-scraper/filters/vinted-api \\
+        --value '{"*": {"max_price": 1500}, "loro piana": {"max_price": 4000, "sizes": ["M", "L"]}}'
+
+The Vinted API and catalog searches take the max price, catalog ids and
+conditions as query parameters, so fewer items are downloaded. Sellpy has no
+such parameters. The price, size and condition rules are also compiled into
+one predicate that every parsed listing is checked with, because the search
+price excludes the buyer fee and sizes are only matched client side. A
+listing whose price, size or condition is unknown is kept.
+"""
+import re
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from scraper_common import config, log
+from scraper_common.listing import Listing
+
+FILTERS_PARAMETER = "/serverless-scraper/filters/{}"
+
+# Vinted's status ids, by the condition names of the API and the Swedish site
+CONDITION_IDS = {
+    "new with tags": 6,
+    "new without tags": 1,
+    "very good": 2,
+    "good": 3,
+    "satisfactory": 4,
+    "nytt med etikett": 6,
+    "nytt utan etikett": 1,
+    "mycket bra": 2,
+    "bra": 3,
+    "tillfredsställande": 4,
+}
+
+UNKNOWN_VALUES = ("", "n/a")
+
+
+class FilterSpec(NamedTuple):
+    max_price: Optional[float] = None
+    sizes: Tuple[str, ...] = ()
+    conditions: Tuple[str, ...] = ()
+    catalog_ids: Tuple[int, ...] = ()
+
+
+def get_spec(source: str, brand: str) -> FilterSpec:
+    specs = config.get_json(FILTERS_PARAMETER.format(source), {})
+    return to_spec({**specs.get("*", {}), **specs.get(brand, {})})
+
+
+def to_spec(data: dict) -> FilterSpec:
+    unknown = set(data) - set(FilterSpec._fields)
+    if unknown:
+        log.warning("Ignoring unknown filter keys", keys=sorted(unknown))
+
+    max_price = data.get("max_price")
+    return FilterSpec(
+        max_price=float(max_price) if max_price is not None else None,
+        sizes=tuple(str(size) for size in data.get("sizes", ())),
+        conditions=tuple(str(condition) for condition in data.get("conditions", ())),
+        catalog_ids=tuple(int(catalog_id) for catalog_id in data.get("catalog_ids", ())),
+    )
+
+
+def get_status_ids(spec: FilterSpec) -> List[int]:
+    return sorted(
+        {
+            CONDITION_IDS[condition.lower()]
+            for condition in spec.conditions
+            if condition.lower() in CONDITION_IDS
+        }
+    )
+
+
+def vinted_api_params(spec: FilterSpec) -> List[Tuple[str, str]]:
+    params = []
+    if spec.max_price is not None:
+        params.append(("price_to", f"{spec.max_price:g}"))
+    if spec.catalog_ids:
+        params.append(("catalog_ids", ",".join(map(str, spec.catalog_ids))))
+    status_ids = get_status_ids(spec)
+    if status_ids:
+        params.append(("status_ids", ",".join(map(str, status_ids))))
+    return params
+
+
+def vinted_catalog_params(spec: FilterSpec) -> List[Tuple[str, str]]:
+    params = []
+    if spec.max_price is not None:
+        params.append(("price_to", f"{spec.max_price:g}"))
+    params += [("catalog[]", str(catalog_id)) for catalog_id in spec.catalog_ids]
+    params += [("status_ids[]", str(status_id)) for status_id in get_status_ids(spec)]
+    return params
+
+
+def with_params(url: str, params: List[Tuple[str, str]]) -> str:
+    """Sets query parameters of ``url``, replacing any it already has with the same name."""
+    if not params:
+        return url
+
+    # Only whole parameters are dropped, so the search text is left as it is
+    base, _, query = url.partition("?")
+    names = {name for name, _ in params}
+    parts = [part for part in query.split("&") if part and part.split("=", 1)[0] not in names]
+    parts += [f"{name}={value}" for name, value in params]
+    return f"{base}?{'&'.join(parts)}"
+
+
+def accept_all(listing: Listing) -> bool:
+    return True
+
+
+def compile_predicate(spec: FilterSpec) -> Callable[[Listing], bool]:
+    """One function that checks a listing against every rule of ``spec``."""
+    checks = []
+
+    if spec.max_price is not None:
+        max_price = spec.max_price
+
+        def check_price(listing: Listing) -> bool:
+            return listing.price is None or listing.price <= max_price
+
+        checks.append(check_price)
+
+    if spec.sizes:
+        sizes = frozenset(size.lower() for size in spec.sizes)
+
+        def check_size(listing: Listing) -> bool:
+            size = listing.size.lower()
+            # Vinted writes sizes in several systems, e.g. "M / 38 / 10"
+            return size in UNKNOWN_VALUES or not sizes.isdisjoint(
+                part.strip() for part in size.split("/")
+            )
+
+        checks.append(check_size)
+
+    if spec.conditions:
+        conditions = frozenset(condition.lower() for condition in spec.conditions)
+        status_ids = frozenset(get_status_ids(spec))
+
+        def check_condition(listing: Listing) -> bool:
+            condition = listing.condition.lower()
+            return (
+                condition in UNKNOWN_VALUES
+                or condition in conditions
+                or CONDITION_IDS.get(condition) in status_ids
+            )
+
+        checks.append(check_condition)
+
+    if not checks:
+        return accept_all
+    if len(checks) == 1:
+        return checks[0]
+
+    def check_all(listing: Listing) -> bool:
+        for check in checks:
+            if not check(listing):
+                return False
+        return True
+
+    return check_all
+
+
+_brand_patterns: Dict[int, tuple] = {}
+
+
+def brand_pattern(brands: List[str]):
+    """One regex matching any of ``brands`` in a lowercased brand name.
+
+    Kept per brand list object, config returns the same list until the
+    parameter changes, so the pattern is compiled once per list.
+    """
+    cached = _brand_patterns.get(id(brands))
+    if cached is None or cached[0] is not brands:
+        if brands:
+            pattern = re.compile("|".join(re.escape(brand.lower()) for brand in brands))
+        else:
+            pattern = re.compile(r"(?!)")
+        cached = (brands, pattern)
+        _brand_patterns[id(brands)] = cached
+    return cached[1]
+
+
+def is_approved_brand(brand: Optional[str], brands: List[str]) -> bool:
+    return bool(brand) and brand_pattern(brands).search(brand.lower()) is not None
@@ -0,0 +1,101 @@
+"""The listing record shared by all scrapers.
+
+A Listing is a NamedTuple, so a parsed listing is one small tuple instead of
+a dict, and the mapping to DynamoDB items, JSON and email cards is written
+once here instead of in every scraper. Prices are kept as a number and a
+currency code, parsed from whatever text or amount the marketplace shows.
+"""
+import re
+from typing import NamedTuple, Optional, Tuple
+
+CURRENCY_SYMBOLS = {"kr": "SEK", "€": "EUR", "£": "GBP", "$": "USD"}
+
+# Digits with thousands and decimal separators, e.g. "1 234,50" or "99.0"
+_NUMBER = re.compile(r"\d[\d\s.,]*")
+_CURRENCY_CODE = re.compile(r"\b[A-Z]{3}\b")
+_WHITESPACE = re.compile(r"\s")
+
+
+class Listing(NamedTuple):
+    id: str
+    brand: str
+    url: str
+    img_url: str
+    title: str = ""
+    size: str = ""
+    condition: str = ""
+    currency: str = ""
+    # Last, so every field before it is a string attribute in DynamoDB
+    price: Optional[float] = None
+
+    @property
+    def price_text(self) -> str:
+        return format_price(self.price, self.currency)
+
+    def get(self, field: str, default=None):
+        return getattr(self, field, default)
+
+    def to_dynamo_item(self) -> dict:
+        item = {
+            field: {"S": value}
+            for field, value in zip(STRING_FIELDS, self)
+            if value
+        }
+        if self.price is not None:
+            item["price"] = {"N": repr(self.price)}
+        return item
+
+    def to_json(self) -> dict:
+        return self._asdict()
+
+    def to_card(self) -> dict:
+        card = self._asdict()
+        card["price"] = self.price_text
+        return card
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Listing":
+        return cls(**data)
+
+
+STRING_FIELDS = Listing._fields[:-1]
+
+
+def parse_price(text) -> Tuple[Optional[float], str]:
+    """Splits a price such as ``"1 234,50 kr"`` or ``"99.0 SEK"`` into amount and currency."""
+    if text is None:
+        return None, ""
+    text = str(text)
+    currency = parse_currency(text)
+
+    match = _NUMBER.search(text)
+    if match is None:
+        return None, currency
+
+    number = _WHITESPACE.sub("", match.group()).rstrip(".,")
+    if "," in number and "." in number:
+        # Whichever separator comes last is the decimal one
+        thousands = "," if number.rfind(",") < number.rfind(".") else "."
+        number = number.replace(thousands, "")
+    number = number.replace(",", ".")
+    if number.count(".") > 1:
+        number = number.replace(".", "", number.count(".") - 1)
+    return float(number), currency
+
+
+def parse_currency(text: str) -> str:
+    match = _CURRENCY_CODE.search(text)
+    if match:
+        return match.group()
+    lowered = text.lower()
+    for symbol, code in CURRENCY_SYMBOLS.items():
+        if symbol in lowered:
+            return code
+    return ""
+
+
+def format_price(price: Optional[float], currency: str) -> str:
+    if price is None:
+        return ""
+    amount = f"{price:.2f}" if price % 1 else f"{price:.0f}"
+    return f"{amount} {currency}".strip()
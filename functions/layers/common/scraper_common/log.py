@@ -0,0 +1,164 @@
+"""Levelled, structured logging with sampling and size-capped summaries.
+
+Records below LOG_LEVEL (default INFO) are dropped before they are
+formatted. In Lambda each record is one JSON line with the trace id of the
+current span, run locally it is a plain text line (LOG_FORMAT overrides
+either).
+
+Noisy per-item messages take a ``sample`` rate: the first occurrence of a
+message is always written, later ones with that probability, and the number
+suppressed is reported when the handler finishes. Collections are logged
+with ``summary()``, which writes the count and the first few items instead
+of the whole list.
+
+The bytes and lines written per invocation are reported as the log.bytes
+and log.lines metrics. Handlers running at the same time in one process
+each count their own.
+"""
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from scraper_common import tracing
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+LOG_LEVEL = LEVELS.get(os.getenv("LOG_LEVEL", "INFO").upper(), LEVELS["INFO"])
+LOG_FORMAT = os.getenv(
+    "LOG_FORMAT", "json" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else "text"
+)
+
+SUMMARY_ITEMS = int(os.getenv("LOG_SUMMARY_ITEMS", "5"))
+SUMMARY_MAX_CHARS = int(os.getenv("LOG_SUMMARY_MAX_CHARS", "2000"))
+
+class Counts:
+    """Occurrences and written records of sampled messages, and output totals."""
+
+    def __init__(self):
+        self.seen = Counter()
+        self.written = Counter()
+        self.totals = Counter()
+
+
+_lock = threading.Lock()
+# Written outside an invocation, e.g. while a module is imported, these are
+# counted for the next invocation that starts
+_unscoped = Counts()
+_current = contextvars.ContextVar("log_counts", default=None)
+
+
+def _get_counts() -> Counts:
+    counts = _current.get()
+    return _unscoped if counts is None else counts
+
+
+@contextmanager
+def invocation():
+    """Counts the records of the block apart from those of other threads, see report()."""
+    global _unscoped
+    with _lock:
+        counts, _unscoped = _unscoped, Counts()
+    token = _current.set(counts)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def is_enabled(level: str) -> bool:
+    return LEVELS[level] >= LOG_LEVEL
+
+
+def debug(message: str, sample: float = 1.0, **fields):
+    _log("DEBUG", message, sample, fields)
+
+
+def info(message: str, sample: float = 1.0, **fields):
+    _log("INFO", message, sample, fields)
+
+
+def warning(message: str, sample: float = 1.0, **fields):
+    _log("WARNING", message, sample, fields)
+
+
+def error(message: str, sample: float = 1.0, **fields):
+    _log("ERROR", message, sample, fields)
+
+
+def summary(message: str, items, keys=None, level: str = "INFO", **fields):
+    """Logs how many items there are and the first few, optionally only some keys."""
+    if not is_enabled(level):
+        return
+
+    items = list(items)
+    head = items[:SUMMARY_ITEMS]
+    if keys is not None:
+        head = [{key: item.get(key) for key in keys} for item in head]
+
+    # Kept as a list when it fits, cut as text when the items are large
+    preview = head
+    text = json.dumps(head, ensure_ascii=False, default=str)
+    if len(text) > SUMMARY_MAX_CHARS:
+        preview = text[:SUMMARY_MAX_CHARS] + "..."
+
+    _log(level, message, 1.0, {**fields, "count": len(items), "first": preview})
+
+
+def report() -> Counter:
+    """Returns and resets the counts for this invocation, logging suppressed messages."""
+    with _lock:
+        current = _get_counts()
+        suppressed = {
+            message: seen - current.written[message]
+            for message, seen in current.seen.items()
+            if seen > current.written[message]
+        }
+        current.seen.clear()
+        current.written.clear()
+    if suppressed:
+        info("Sampled out log messages", suppressed=suppressed)
+
+    with _lock:
+        counts = Counter(current.totals)
+        counts["log.suppressed"] = sum(suppressed.values())
+        current.totals.clear()
+    return counts
+
+
+def _log(level: str, message: str, sample: float, fields: dict):
+    if not is_enabled(level):
+        return
+
+    counts = _get_counts()
+    if sample < 1.0:
+        with _lock:
+            counts.seen[message] += 1
+            first = counts.seen[message] == 1
+        if not first and random.random() >= sample:
+            return
+        with _lock:
+            counts.written[message] += 1
+
+    line = _format(level, message, fields)
+    sys.stdout.write(line + "\n")
+
+    with _lock:
+        counts.totals["log.bytes"] += len(line.encode("utf-8")) + 1
+        counts.totals["log.lines"] += 1
+
+
+def _format(level: str, message: str, fields: dict) -> str:
+    if LOG_FORMAT == "json":
+        record = {"level": level, "message": message, **fields}
+        span = tracing.current_span()
+        if span is not None:
+            record["trace_id"] = span.trace_id
+        return json.dumps(record, ensure_ascii=False, default=str)
+
+    details = " ".join(f"{key}={value}" for key, value in fields.items())
+    return f"{level} {message} {details}".rstrip()
@@ -0,0 +1,208 @@
+"""Per-stage pipeline metrics in CloudWatch Embedded Metric Format.
+
+Stages (fetch, parse, dedupe, render, notify) are timed with ``stage()``,
+counters are added with ``add()`` and single measurements, kept as separate
+data points, with ``observe()``. At the end of an invocation ``flush()``
+prints the totals as EMF JSON lines, which CloudWatch Logs turns into
+metrics without any PutMetricData calls. Values recorded with a brand get
+their own line with a Brand dimension. Each invocation of an
+``instrumented`` handler records and flushes its own values.
+
+Set ``METRICS_EXPORTER=memory`` to keep the records in ``exporter.records``
+instead of printing them, e.g. when running a function locally.
+"""
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from scraper_common import log, tracing
+
+NAMESPACE = os.getenv("METRICS_NAMESPACE", "ServerlessScraper")
+
+MILLISECONDS = "Milliseconds"
+COUNT = "Count"
+BYTES = "Bytes"
+MEGABYTES = "Megabytes"
+
+# EMF allows at most 100 metrics per directive
+MAX_METRICS_PER_RECORD = 100
+
+
+class StdoutExporter:
+    def export(self, record: dict):
+        print(json.dumps(record, separators=(",", ":")))
+
+
+class MemoryExporter:
+    def __init__(self):
+        self.records = []
+
+    def export(self, record: dict):
+        self.records.append(record)
+
+    def value(self, name: str, brand: str = None):
+        """Sum of a metric over the exported records, for one brand or the run totals."""
+        total = 0
+        for record in self.records:
+            if name in record and record.get("Brand") == brand:
+                value = record[name]
+                total += sum(value) if isinstance(value, list) else value
+        return total
+
+
+exporter = MemoryExporter() if os.getenv("METRICS_EXPORTER") == "memory" else StdoutExporter()
+
+class Values:
+    """The metrics recorded by one handler invocation."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.brand_totals = defaultdict(lambda: defaultdict(float))
+        self.samples = defaultdict(list)
+        self.units = {}
+
+
+_lock = threading.Lock()
+# Recorded outside an invocation, e.g. while a module is imported, these go
+# to the next invocation that starts
+_unscoped = Values()
+_current = contextvars.ContextVar("metric_values", default=None)
+
+
+def _get_values() -> Values:
+    values = _current.get()
+    return _unscoped if values is None else values
+
+
+@contextmanager
+def invocation():
+    """Records the metrics of the block apart from those of other threads.
+
+    Handlers running at the same time in one process, the daemon's sources
+    or the shards of a local fan-out, each flush only their own. A worker
+    thread of a handler records into it when it runs in a copy of the
+    handler's context (``contextvars.copy_context().run``).
+    """
+    global _unscoped
+    with _lock:
+        values, _unscoped = _unscoped, Values()
+    token = _current.set(values)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def add(name: str, value: float, unit: str = COUNT, brand: str = None):
+    with _lock:
+        values = _get_values()
+        values.units[name] = unit
+        if brand is None:
+            values.totals[name] += value
+        else:
+            values.brand_totals[brand][name] += value
+
+
+def observe(name: str, value: float, unit: str = MILLISECONDS):
+    """Records one data point, e.g. the latency of each message in a batch."""
+    with _lock:
+        values = _get_values()
+        values.units[name] = unit
+        values.samples[name].append(value)
+
+
+@contextmanager
+def stage(name: str, brand: str = None):
+    """Times a pipeline stage, recorded as ``<name>.latency`` in milliseconds.
+
+    The stage is also traced as a span, so the stages of a run nest under the
+    handler span.
+    """
+    attributes = {"brand": brand} if brand else {}
+    started = time.perf_counter()
+    try:
+        with tracing.span(name, **attributes):
+            yield
+    finally:
+        add(f"{name}.latency", (time.perf_counter() - started) * 1000, MILLISECONDS, brand)
+
+
+def add_consumed_capacity(response: dict, stage_name: str = "dedupe"):
+    """Adds the capacity units from a DynamoDB call made with ReturnConsumedCapacity."""
+    capacity = response.get("ConsumedCapacity")
+    # Batch operations report a list with an entry per table
+    if isinstance(capacity, list):
+        add(f"{stage_name}.capacity_units", sum(c.get("CapacityUnits", 0) for c in capacity))
+    elif capacity:
+        add(f"{stage_name}.capacity_units", capacity.get("CapacityUnits", 0))
+
+
+def flush(source: str):
+    with _lock:
+        current = _get_values()
+        values = dict(current.totals)
+        values.update({name: list(samples) for name, samples in current.samples.items()})
+        brand_values = {brand: dict(v) for brand, v in current.brand_totals.items()}
+        units = dict(current.units)
+        current.totals.clear()
+        current.samples.clear()
+        current.brand_totals.clear()
+
+    if values:
+        _export(values, units, {"Source": source})
+    for brand, values in brand_values.items():
+        _export(values, units, {"Source": source, "Brand": brand})
+
+
+def instrumented(source: str):
+    """Decorates a Lambda handler so the metrics are flushed when it returns or fails."""
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            with log.invocation(), invocation():
+                try:
+                    with stage("handler"):
+                        return handler(event, context)
+                finally:
+                    for name, value in log.report().items():
+                        add(name, value, BYTES if name == "log.bytes" else COUNT)
+                    flush(source)
+
+        return wrapper
+
+    return decorator
+
+
+def _export(values: dict, units: dict, dimensions: dict):
+    names = sorted(values)
+    for start in range(0, len(names), MAX_METRICS_PER_RECORD):
+        chunk = names[start : start + MAX_METRICS_PER_RECORD]
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": NAMESPACE,
+                        "Dimensions": [list(dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": units.get(name, COUNT)}
+                            for name in chunk
+                        ],
+                    }
+                ],
+            },
+            **dimensions,
+        }
+        for name in chunk:
+            value = values[name]
+            if isinstance(value, list):
+                record[name] = [round(sample, 3) for sample in value]
+            else:
+                record[name] = round(value, 3)
+        exporter.export(record)
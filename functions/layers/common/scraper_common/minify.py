@@ -0,0 +1,57 @@
+"""Shrink rendered email HTML so digests stay below mail-client clipping limits.
+
+Inline ``style`` attributes that occur more than once are moved into a
+``<style>`` block as short classes, and whitespace between and inside tags is
+collapsed. The pass assumes the markup produced by scraper_common.render,
+where elements carry a ``style`` attribute but no ``class`` attribute.
+"""
+import re
+from collections import Counter
+
+STYLE_ATTRIBUTE = re.compile(r' style="([^"]*)"')
+WHITESPACE_BETWEEN_TAGS = re.compile(r">\s+<")
+WHITESPACE_RUN = re.compile(r"\s{2,}")
+BODY_TAG = "<body"
+
+
+def dedupe_styles(html: str) -> str:
+    counts = Counter(STYLE_ATTRIBUTE.findall(html))
+    classes = {}
+    for style, count in counts.most_common():
+        if count > 1:
+            classes[style] = f"s{len(classes)}"
+
+    if not classes:
+        return html
+
+    def replace(match):
+        class_name = classes.get(match.group(1))
+        return f' class="{class_name}"' if class_name else match.group(0)
+
+    html = STYLE_ATTRIBUTE.sub(replace, html)
+    rules = "".join(
+        f".{class_name}{{{compact_style(style)}}}" for style, class_name in classes.items()
+    )
+    head = f"<head><style>{rules}</style></head>"
+
+    index = html.find(BODY_TAG)
+    if index == -1:
+        return head + html
+    return html[:index] + head + html[index:]
+
+
+def compact_style(style: str) -> str:
+    return ";".join(
+        declaration.strip().replace(": ", ":")
+        for declaration in style.split(";")
+        if declaration.strip()
+    )
+
+
+def collapse_whitespace(html: str) -> str:
+    html = WHITESPACE_BETWEEN_TAGS.sub("><", html)
+    return WHITESPACE_RUN.sub(" ", html).strip()
+
+
+def minify_html(html: str) -> str:
+    return collapse_whitespace(dedupe_styles(html))
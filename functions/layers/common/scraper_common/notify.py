@@ -0,0 +1,112 @@
+"""Queue rendered digests for the email-send function.
+
+``deliver`` is how the scrapers send their new listings: as a fragment of
+the combined digest with DIGEST_MODE=combined, otherwise as a digest of
+their own.
+
+Most digests are far below the SQS message size limit, so the HTML is gzipped
+and inlined in the message body. Only digests that do not fit are uploaded
+to S3 and referenced by object key.
+"""
+import base64
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+from typing import List
+
+from scraper_common import config, digest, log, metrics, tracing
+from scraper_common.clients import get_client
+from scraper_common.listing import Listing
+from scraper_common.render import CardTemplate, render_digest_pages
+
+# SQS messages are limited to 256 KB, leave room for the other message fields
+MAX_INLINE_BYTES = 200_000
+
+
+def encode_html(html: str) -> str:
+    return base64.b64encode(gzip.compress(html.encode("utf-8"))).decode("ascii")
+
+
+def decode_html(data: str) -> str:
+    return gzip.decompress(base64.b64decode(data)).decode("utf-8")
+
+
+def read_html(body: dict, s3, bucket_name: str) -> str:
+    """Return the HTML of a queued message, inline or from S3."""
+    if "html_gz" in body:
+        return decode_html(body["html_gz"])
+
+    response = s3.get_object(Bucket=bucket_name, Key=body["object_key"])
+    return response["Body"].read().decode("utf-8")
+
+
+def deliver(
+    source: str, listings: List[Listing], card: CardTemplate, subject: str, event: dict
+):
+    if not listings:
+        return
+
+    if digest.is_combined_digest():
+        # digest-send joins this with the other scrapers' results when the window closes
+        with metrics.stage("notify"):
+            digest.save_fragment(source, listings, card, event.get("time"))
+        return
+
+    with metrics.stage("render"):
+        pages = render_digest_pages(listings, card)
+    log.debug("HTML generated", pages=len(pages))
+
+    with metrics.stage("notify"):
+        queue_digest(pages, source, subject, source.lower())
+
+
+def queue_digest(pages: List[str], sender_name: str, subject: str, key_prefix: str):
+    recipient = config.get_parameter(config.RECIPIENT_PARAMETER)
+
+    for page, html in enumerate(pages, start=1):
+        page_suffix = f" ({page}/{len(pages)})" if len(pages) > 1 else ""
+        message = {
+            "sender_name": sender_name,
+            "subject": f"{subject}{page_suffix}",
+            "recipient": recipient,
+        }
+
+        encoded = encode_html(html)
+        if len(encoded) <= MAX_INLINE_BYTES:
+            message["html_gz"] = encoded
+            log.debug("Inlined HTML", bytes=len(html), encoded_bytes=len(encoded))
+        else:
+            message["object_key"] = upload_html_to_s3(html, key_prefix, page)
+
+        push_event_to_sqs(message)
+
+
+def upload_html_to_s3(html: str, key_prefix: str, page: int = 1) -> str:
+    bucket_name = os.environ["S3_HTML_BUCKET"]
+    date_key = datetime.now(timezone.utc).strftime("%Y-%m-%d")  # e.g. "2025-06-28"
+    page_suffix = f"-{page}" if page > 1 else ""
+    object_key = f"{key_prefix}/{date_key}{page_suffix}.html"
+
+    s3 = get_client("s3")
+    with tracing.span("s3.upload", key=object_key, bytes=len(html)):
+        s3.put_object(
+            Bucket=bucket_name, Key=object_key, Body=html, ContentType="text/html"
+        )
+
+    log.info("Uploaded HTML", key=object_key, bytes=len(html))
+    return object_key
+
+
+def push_event_to_sqs(message: dict):
+    sqs = get_client("sqs")
+
+    # email-send continues the trace from the context carried in the message
+    with tracing.span("sqs.publish") as span:
+        response = sqs.send_message(
+            QueueUrl=os.environ["SQS_EMAIL_QUEUE"],
+            MessageBody=json.dumps(tracing.inject(message)),
+        )
+        span.set_attribute("message_id", response["MessageId"])
+
+    log.info("Message published to SQS", message_id=response["MessageId"])
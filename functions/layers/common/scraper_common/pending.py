@@ -0,0 +1,74 @@
+"""The new listings of a run, from the first brand saved until they are notified.
+
+``dispatch`` gives one Pending to a run's ``scrape``, which adds the
+listings it stored brand by brand. ``seen`` holds the ids of every listing
+the run has written so far, so a listing that a later search returns again
+is dropped before it reaches DynamoDB.
+
+The listings are kept in memory. Only a fan-out shard, whose listings are
+notified by the aggregate step in another invocation, ``save()``s them to
+``pending/<source>/`` in the HTML bucket and passes the key on, which keeps
+them out of the 256 KB Step Functions state. The aggregate step ``adopt()``s
+the keys of all shards and ``clear()``s them once they are notified.
+"""
+import json
+import os
+import uuid
+from typing import List, Set
+
+from scraper_common import log
+from scraper_common.clients import get_client
+from scraper_common.listing import Listing
+
+PENDING_PREFIX = "pending/"
+
+# Most keys one DeleteObjects request takes
+DELETE_BATCH_SIZE = 1000
+
+
+class Pending:
+    def __init__(self, source: str):
+        self.source = source
+        self.seen: Set[str] = set()
+        self.keys: List[str] = []
+        self.listings: List[Listing] = []
+
+    def add(self, listings: List[Listing]):
+        """Keeps listings that were just stored until they are notified."""
+        self.listings += listings
+
+    def save(self) -> List[str]:
+        """Writes the listings to the bucket in one object, returns the keys to adopt."""
+        if not self.listings:
+            return []
+
+        key = f"{PENDING_PREFIX}{self.source}/{uuid.uuid4()}.json"
+        get_client("s3").put_object(
+            Bucket=os.environ["S3_HTML_BUCKET"],
+            Key=key,
+            Body=json.dumps([listing.to_json() for listing in self.listings]),
+            ContentType="application/json",
+        )
+        log.info("Saved pending listings", key=key, count=len(self.listings))
+        return [key]
+
+    def adopt(self, keys: List[str]):
+        """Loads listings saved by other invocations, e.g. fan-out shards."""
+        bucket_name = os.environ["S3_HTML_BUCKET"]
+        s3 = get_client("s3")
+
+        for key in keys:
+            response = s3.get_object(Bucket=bucket_name, Key=key)
+            items = json.loads(response["Body"].read())
+            self.listings += [Listing.from_json(item) for item in items]
+            self.keys.append(key)
+
+    def clear(self):
+        """Deletes the adopted objects, call once the listings are notified."""
+        bucket_name = os.environ["S3_HTML_BUCKET"]
+        for i in range(0, len(self.keys), DELETE_BATCH_SIZE):
+            batch = self.keys[i : i + DELETE_BATCH_SIZE]
+            get_client("s3").delete_objects(
+                Bucket=bucket_name, Delete={"Objects": [{"Key": key} for key in batch]}
+            )
+        self.keys = []
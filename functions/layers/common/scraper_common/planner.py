@@ -0,0 +1,100 @@
+"""Plan the searches of a run so overlapping brands are fetched once.
+
+Brand searches overlap in two ways. Aliases such as "ermenegildo" and
+"zegna" return the same items, and a search whose words are a superset of
+another's ("brunello cucinelli" and "cucinelli") returns a subset of its
+items. ``plan_queries`` keeps the first brand of every alias group and drops
+brands whose words contain another brand's words. Their listings still come
+in through the broader search and pass the approved brand check, which
+covers the full brand list. Brands are only merged when they have the same
+filters, and the broader search is capped at the same page size, so a very
+busy broad search can push older items of the narrow one out.
+
+Alias groups are a JSON list of lists at /serverless-scraper/aliases.
+
+Listings found by several searches of a run are dropped by
+``drop_duplicates`` before they are written. Both the searches and the
+writes saved are reported as metrics.
+"""
+import re
+from typing import Iterable, List, NamedTuple, Optional, Set
+
+from scraper_common import config, filters, log, metrics
+from scraper_common.listing import Listing
+
+ALIASES_PARAMETER = "/serverless-scraper/aliases"
+DEFAULT_ALIASES = [["zegna", "ermenegildo", "ermenegildo zegna"]]
+
+# Sellpy joins the words of a search with "+"
+_SEPARATORS = re.compile(r"[\s+]+")
+
+
+def get_words(brand: str) -> frozenset:
+    return frozenset(word for word in _SEPARATORS.split(brand.lower()) if word)
+
+
+class _Search(NamedTuple):
+    index: int
+    brand: str
+    words: frozenset
+    spec: filters.FilterSpec
+    alias_group: Optional[int]
+
+    def covers(self, other: "_Search") -> bool:
+        if self.spec != other.spec:
+            return False
+        if self.alias_group is not None and self.alias_group == other.alias_group:
+            return True
+        return self.words <= other.words
+
+
+def plan_queries(source: str, brands: List[str]) -> List[str]:
+    """The brands to search for, in their original order, without overlapping ones."""
+    alias_groups = {}
+    for index, group in enumerate(config.get_json(ALIASES_PARAMETER, DEFAULT_ALIASES)):
+        for alias in group:
+            alias_groups[get_words(alias)] = index
+
+    searches = []
+    for index, brand in enumerate(brands):
+        words = get_words(brand)
+        spec = filters.get_spec(source, brand)
+        searches.append(_Search(index, brand, words, spec, alias_groups.get(words)))
+
+    # Fewest words first, so the broadest search of a family is kept
+    kept = []
+    merged = {}
+    for search in sorted(searches, key=lambda search: len(search.words)):
+        covering = next((other for other in kept if other.covers(search)), None)
+        if covering is None:
+            kept.append(search)
+        else:
+            merged[search.brand] = covering.brand
+
+    queries = [search.brand for search in sorted(kept)]
+    if merged:
+        log.info("Merged overlapping searches", searches=len(queries), merged=merged)
+    metrics.add("plan.fetches_saved", len(merged))
+    return queries
+
+
+def drop_duplicates(listings: Iterable[Listing], seen: Optional[Set[str]] = None) -> List[Listing]:
+    """Keeps the first listing per id, a listing found by two searches is written once.
+
+    A run that writes brand by brand passes the same ``seen`` to every call,
+    so listings of earlier brands are dropped as well.
+    """
+    seen = set() if seen is None else seen
+    unique = []
+    duplicates = 0
+    for listing in listings:
+        if listing.id in seen:
+            duplicates += 1
+            continue
+        seen.add(listing.id)
+        unique.append(listing)
+
+    if duplicates:
+        log.info("Dropped duplicate listings", duplicates=duplicates)
+    metrics.add("dedupe.writes_saved", duplicates)
+    return unique
@@ -0,0 +1,169 @@
+"""Opt-in profiling of a Lambda handler.
+
+Decorate a handler with ``profiled(source)`` and set ``PROFILE=1`` on the
+function, or invoke it with ``{"profile": true}`` in the event, to run it
+under cProfile with tracemalloc and a stack sampler. Three reports are
+written per run under ``profiles/<source>/<timestamp>/``:
+
+* ``handler.pstats``: cProfile output, open with ``python -m pstats`` or snakeviz
+* ``stacks.collapsed``: sampled stacks, input for flamegraph.pl or speedscope
+* ``allocations.txt``: the lines holding the most memory at the end of the run
+
+Reports go to the S3_HTML_BUCKET bucket, or to PROFILE_DIR (default
+``profiles``) when ``ENVIRONMENT=local``. Without the flag the handler runs
+unchanged.
+"""
+import cProfile
+import functools
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+
+from scraper_common import log
+from scraper_common.clients import get_client
+
+SAMPLE_INTERVAL_SECONDS = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.01"))
+TOP_ALLOCATIONS = int(os.getenv("PROFILE_TOP_ALLOCATIONS", "25"))
+TRACEMALLOC_FRAMES = 10
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of all other threads into collapsed stack counts."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL_SECONDS):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                self.stacks[collapse(names.get(thread_id, "thread"), frame)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+def collapse(thread_name: str, frame) -> str:
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        frames.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join([thread_name] + frames[::-1])
+
+
+def is_enabled(event) -> bool:
+    if os.getenv("PROFILE", "").lower() in ("1", "true"):
+        return True
+    return isinstance(event, dict) and bool(event.get("profile"))
+
+
+def profiled(source: str):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not is_enabled(event):
+                return handler(event, context)
+
+            profiler = cProfile.Profile()
+            sampler = StackSampler()
+            tracing_memory = tracemalloc.is_tracing()
+            if not tracing_memory:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+
+            started = time.perf_counter()
+            sampler.start()
+            profiler.enable()
+            try:
+                return handler(event, context)
+            finally:
+                profiler.disable()
+                sampler.stop()
+                elapsed = time.perf_counter() - started
+                snapshot = tracemalloc.take_snapshot()
+                if not tracing_memory:
+                    tracemalloc.stop()
+
+                reports = {
+                    "handler.pstats": dump_stats(profiler),
+                    "stacks.collapsed": sampler.collapsed().encode("utf-8"),
+                    "allocations.txt": format_allocations(snapshot).encode("utf-8"),
+                }
+                samples = sum(sampler.stacks.values())
+                log.info(
+                    "Profiled handler",
+                    source=source,
+                    seconds=round(elapsed, 2),
+                    samples=samples,
+                )
+                save_reports(source, reports)
+
+        return wrapper
+
+    return decorator
+
+
+def dump_stats(profiler: cProfile.Profile) -> bytes:
+    # pstats only writes its binary format to a file
+    with tempfile.NamedTemporaryFile(suffix=".pstats") as file:
+        profiler.dump_stats(file.name)
+        return file.read()
+
+
+def format_allocations(snapshot: tracemalloc.Snapshot, limit: int = TOP_ALLOCATIONS) -> str:
+    snapshot = snapshot.filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        )
+    )
+    statistics = snapshot.statistics("lineno")
+    total = sum(stat.size for stat in statistics)
+
+    lines = [f"Total traced: {total / 1024:.1f} KiB in {len(statistics)} lines"]
+    for index, stat in enumerate(statistics[:limit], 1):
+        frame = stat.traceback[0]
+        lines.append(
+            f"#{index}: {frame.filename}:{frame.lineno}: "
+            f"{stat.size / 1024:.1f} KiB in {stat.count} blocks"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def save_reports(source: str, reports: dict):
+    run = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    prefix = f"profiles/{source}/{run}"
+
+    try:
+        if os.getenv("ENVIRONMENT") == "local":
+            directory = os.path.join(os.getenv("PROFILE_DIR", "profiles"), source, run)
+            os.makedirs(directory, exist_ok=True)
+            for name, body in reports.items():
+                with open(os.path.join(directory, name), "wb") as file:
+                    file.write(body)
+            log.info("Profile written", directory=directory)
+        else:
+            s3 = get_client("s3")
+            for name, body in reports.items():
+                s3.put_object(
+                    Bucket=os.environ["S3_HTML_BUCKET"], Key=f"{prefix}/{name}", Body=body
+                )
+            log.info("Profile uploaded", url=f"s3://{os.environ['S3_HTML_BUCKET']}/{prefix}/")
+    except Exception as e:
+        # A failed upload should not fail the run that was profiled
+        log.warning("Failed to save profile", error=str(e))
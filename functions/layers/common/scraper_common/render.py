@@ -0,0 +1,243 @@
+"""HTML email rendering shared by all scrapers.
+
+The page, brand section and card templates are compiled once and the output
+is collected in a list that is joined at the end, so rendering time grows
+linearly with the number of listings. All listing fields are HTML escaped,
+prices are shown as formatted by ``Listing.price_text``.
+
+Run ``python -m scraper_common.render`` for a small scaling benchmark.
+"""
+import math
+import string
+import time
+from collections import defaultdict
+from html import escape
+from typing import Callable, Dict, Iterable, List, Sequence
+
+from scraper_common import log
+from scraper_common.listing import Listing
+from scraper_common.minify import minify_html
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html>
+<body style="font-family: Arial, sans-serif; font-size: 14px; color: #333; margin:0; padding:0;">
+"""
+
+PAGE_TAIL = """</body>
+</html>
+"""
+
+BRAND_HEAD = """
+  <table width="600" cellpadding="0" cellspacing="0" border="0" align="center" style="border-collapse: collapse; margin-bottom: 20px;">
+    <tr>
+      <td style="padding: 15px 0 5px 10px;">
+        <div style="font-weight: bold; font-size: 28px; padding-bottom: 10px;">
+          {brand}
+        </div>
+      </td>
+    </tr>
+    <tr><td style="height: 10px;"></td></tr>
+"""
+
+BRAND_TAIL = "  </table>\n"
+
+ROW_HEAD = "    <tr>\n"
+ROW_TAIL = "    </tr>\n"
+EMPTY_CELL = '      <td width="50%" valign="top" style="padding: 10px;"></td>\n'
+
+CARD_HEAD = """      <td width="50%" valign="top" style="padding: 10px;">
+<table width="100%" cellpadding="0" cellspacing="0" border="0" style="border: 1px solid #ddd; border-collapse: collapse; font-family: Arial, sans-serif; font-size: 14px;">
+  <tr>
+    <td align="center" style="padding-bottom: 10px;">
+      <a href="{url}" target="_blank">
+        <img src="{img_url}" alt="" style="width: 100%; height: auto; display: block;">
+      </a>
+    </td>
+  </tr>
+  <tr>
+    <td align="left" style="padding: 10px; font-weight: bold; font-size: 16px; color: #222;">
+      {brand}
+    </td>
+  </tr>
+"""
+
+DETAIL_ROW = """  <tr>
+    <td align="left" style="padding: {padding}; color: #333;">
+      {content}
+    </td>
+  </tr>
+"""
+
+CARD_TAIL = """  <tr>
+    <td align="left" style="padding: 0 10px 10px 10px; color: #777; font-size: 12px;">
+      ID: {id}
+    </td>
+  </tr>
+</table>
+      </td>
+"""
+
+CARDS_PER_ROW = 2
+
+# Gmail clips messages larger than ~102 KB, keep each email page below that
+MAX_EMAIL_BYTES = 100_000
+
+render_brand_head = BRAND_HEAD.format
+
+
+class CardTemplate:
+    """A listing card with one detail row per entry in ``details``.
+
+    Details are format strings over listing fields, for example
+    ``"<b>Size:</b> {size}"``. They are combined with the fixed card markup
+    into a single format string when the template is created.
+    """
+
+    def __init__(self, details: Sequence[str]):
+        rows = []
+        for i, content in enumerate(details):
+            padding = "0 10px 5px 10px" if i == len(details) - 1 else "0 10px 0px 10px"
+            rows.append(
+                DETAIL_ROW.replace("{padding}", padding).replace("{content}", content)
+            )
+
+        template = CARD_HEAD + "".join(rows) + CARD_TAIL
+        self._format = template.format
+        self.fields = sorted(
+            {"id", "brand", "url", "img_url"}
+            | {field for content in details for field in _field_names(content)}
+        )
+
+    def render(self, listing: Listing) -> str:
+        card = listing.to_card()
+        return self._format(
+            **{field: escape(str(card.get(field, ""))) for field in self.fields}
+        )
+
+
+def _field_names(template: str) -> List[str]:
+    return [name for _, name, _, _ in string.Formatter().parse(template) if name]
+
+
+def render_cards(listings: Iterable[Listing], card: CardTemplate) -> Dict[str, List[str]]:
+    cards_by_brand = defaultdict(list)
+    for listing in listings:
+        cards_by_brand[listing.brand].append(card.render(listing))
+    return cards_by_brand
+
+
+def write_page(write: Callable[[str], object], cards_by_brand: Dict[str, List[str]]):
+    """Stream a page of pre-rendered cards, grouped by brand, to ``write``."""
+    write(PAGE_HEAD)
+
+    for brand, cards in cards_by_brand.items():
+        write(render_brand_head(brand=escape(str(brand))))
+
+        for i in range(0, len(cards), CARDS_PER_ROW):
+            row = cards[i : i + CARDS_PER_ROW]
+            write(ROW_HEAD)
+            for card_html in row:
+                write(card_html)
+            for _ in range(CARDS_PER_ROW - len(row)):
+                write(EMPTY_CELL)
+            write(ROW_TAIL)
+
+        write(BRAND_TAIL)
+
+    write(PAGE_TAIL)
+
+
+def render_page(cards_by_brand: Dict[str, List[str]]) -> str:
+    parts = []
+    write_page(parts.append, cards_by_brand)
+    return "".join(parts)
+
+
+def render_digest(listings: Iterable[Listing], card: CardTemplate) -> str:
+    return render_page(render_cards(listings, card))
+
+
+def render_digest_pages(
+    listings: Iterable[Listing], card: CardTemplate, max_bytes: int = MAX_EMAIL_BYTES
+) -> List[str]:
+    """Render minified pages that each stay below ``max_bytes``."""
+    cards_by_brand = render_cards(listings, card)
+    html = render_page(cards_by_brand)
+
+    pages = render_pages(cards_by_brand, max_bytes, minify_html(html))
+
+    log.info(
+        "Rendered digest",
+        html_bytes=len(html.encode()),
+        minified_bytes=sum(len(page.encode()) for page in pages),
+        pages=len(pages),
+    )
+    return pages
+
+
+def render_pages(
+    cards_by_brand: Dict[str, List[str]], max_bytes: int, html: str = None
+) -> List[str]:
+    if html is None:
+        html = minify_html(render_page(cards_by_brand))
+    size = len(html.encode())
+    card_count = sum(len(cards) for cards in cards_by_brand.values())
+
+    if size <= max_bytes or card_count <= 1:
+        return [html]
+
+    pages = []
+    for chunk in split_cards(cards_by_brand, math.ceil(size / max_bytes)):
+        pages += render_pages(chunk, max_bytes)
+    return pages
+
+
+def split_cards(
+    cards_by_brand: Dict[str, List[str]], parts: int
+) -> List[Dict[str, List[str]]]:
+    """Split cards into ``parts`` chunks of similar size, keeping brand order."""
+    all_cards = [
+        (brand, card_html) for brand, cards in cards_by_brand.items() for card_html in cards
+    ]
+    parts = max(2, min(parts, len(all_cards)))
+    chunk_size = math.ceil(len(all_cards) / parts)
+
+    chunks = []
+    for i in range(0, len(all_cards), chunk_size):
+        chunk = defaultdict(list)
+        for brand, card_html in all_cards[i : i + chunk_size]:
+            chunk[brand].append(card_html)
+        chunks.append(chunk)
+    return chunks
+
+
+def benchmark(sizes: Sequence[int] = (100, 1000, 5000, 20000)):
+    card = CardTemplate(("<b>Size:</b> {size}", "<b>Price:</b> {price}"))
+
+    for size in sizes:
+        listings = [
+            Listing(
+                id=str(i),
+                brand=f"Brand {i % 30}",
+                url=f"https://example.com/items/{i}?a=1&b=2",
+                img_url=f"https://example.com/images/{i}.jpeg",
+                size="M",
+                currency="SEK",
+                price=123.45,
+            )
+            for i in range(size)
+        ]
+
+        start = time.perf_counter()
+        html = render_digest(listings, card)
+        elapsed = time.perf_counter() - start
+
+        print(
+            f"{size:>6} listings: {elapsed * 1000:8.1f} ms, "
+            f"{elapsed / size * 1e6:6.2f} us/listing, {len(html) / 1024:8.0f} KB, "
+            f"{len(minify_html(html)) / 1024:8.0f} KB minified"
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,200 @@
+"""Adaptive per-brand polling based on how many new listings each brand yields.
+
+Every brand of a source is in one frequency tier. An EventBridge rule per
+tier invokes the scrapers with ``{"tier": ..., "time": ...}`` and
+``select_brands`` picks the brands that are in that tier, so brands with a
+steady stream of new listings are polled every 15 minutes and quiet ones
+once a day.
+
+During a run the scrapers pass what they fetched per brand to
+``observe()``, and at its end scraper_common.fanout.dispatch passes the new
+listings to ``save()``, which updates the brand's new listings per day and
+fetch latency (both exponentially weighted averages) in the STATS_TABLE
+DynamoDB table and moves it to the tier its rate calls for.
+Brands without stats start in DEFAULT_TIER. Without STATS_TABLE, or for an
+event without a tier, every brand is scraped and nothing is recorded.
+
+The tier names and schedules are mirrored in cdk/web_scraper_stack.py.
+"""
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from scraper_common import log
+from scraper_common.clients import get_client
+
+
+class Tier(NamedTuple):
+    name: str
+    minutes: int
+    # Brands with at least this many new listings per day are polled this often
+    min_daily_rate: float
+
+
+TIERS = (
+    Tier("fast", 15, 24.0),
+    Tier("hourly", 60, 2.0),
+    Tier("daily", 24 * 60, 0.0),
+)
+DEFAULT_TIER = "hourly"
+
+# Weight of the newest run in the averages
+SMOOTHING = 0.3
+
+# Runs closer together than this are treated as this far apart, so a manual
+# rerun right after a scheduled one does not count as a day without listings
+MIN_ELAPSED_SECONDS = 15 * 60
+
+
+class BrandStats(NamedTuple):
+    brand: str
+    tier: str = DEFAULT_TIER
+    daily_rate: float = 0.0
+    latency_ms: float = 0.0
+    last_run: float = 0.0
+    runs: int = 0
+
+
+# source -> brand -> (ids of the fetched listings, seconds spent on the brand),
+# per thread. A run scrapes and saves on one thread, so concurrent shards of a
+# local fan-out (or the daemon's sources) each save only their own brands.
+_local = threading.local()
+
+
+def _get_observed() -> dict:
+    if not hasattr(_local, "observed"):
+        _local.observed = defaultdict(dict)
+    return _local.observed
+
+
+def get_table_name() -> Optional[str]:
+    return os.getenv("STATS_TABLE")
+
+
+def get_tier(daily_rate: float) -> str:
+    for tier in TIERS:
+        if daily_rate >= tier.min_daily_rate:
+            return tier.name
+    return TIERS[-1].name
+
+
+def load_stats(source: str) -> Dict[str, BrandStats]:
+    table_name = get_table_name()
+    if table_name is None:
+        return {}
+
+    dynamodb = get_client("dynamodb")
+    paginator = dynamodb.get_paginator("query")
+    stats = {}
+    for page in paginator.paginate(
+        TableName=table_name,
+        KeyConditionExpression="#source = :source",
+        ExpressionAttributeNames={"#source": "source"},
+        ExpressionAttributeValues={":source": {"S": source}},
+    ):
+        for item in page["Items"]:
+            stats[item["brand"]["S"]] = BrandStats(
+                brand=item["brand"]["S"],
+                tier=item["tier"]["S"],
+                daily_rate=float(item["daily_rate"]["N"]),
+                latency_ms=float(item["latency_ms"]["N"]),
+                last_run=float(item["last_run"]["N"]),
+                runs=int(item["runs"]["N"]),
+            )
+    return stats
+
+
+def select_brands(source: str, brands: List[str], tier: Optional[str]) -> List[str]:
+    """The brands of ``brands`` that are in ``tier``, or all of them without a tier."""
+    if tier is None or get_table_name() is None:
+        return brands
+
+    stats = load_stats(source)
+    selected = [
+        brand
+        for brand in brands
+        if (stats[brand].tier if brand in stats else DEFAULT_TIER) == tier
+    ]
+    log.info("Selected brands", tier=tier, selected=len(selected), brands=len(brands))
+    return selected
+
+
+def observe(source: str, brand: str, listings: Iterable, seconds: float):
+    """Records the listings fetched for a brand and the time it took."""
+    _get_observed()[source][brand] = ({listing.id for listing in listings}, seconds)
+
+
+def save(source: str, new_listings: Iterable, now: Optional[float] = None):
+    """Updates the stats of the observed brands with how many of their listings were new."""
+    observed = _get_observed().pop(source, {})
+
+    table_name = get_table_name()
+    if table_name is None or not observed:
+        return
+
+    now = time.time() if now is None else now
+    brand_by_id = {
+        listing_id: brand for brand, (ids, _) in observed.items() for listing_id in ids
+    }
+    new_counts = defaultdict(int)
+    for listing in new_listings:
+        brand = brand_by_id.get(listing.id)
+        if brand is not None:
+            new_counts[brand] += 1
+
+    previous = load_stats(source)
+    items = []
+    for brand, (_, seconds) in observed.items():
+        before = previous.get(brand, BrandStats(brand))
+        stats = update_stats(before, new_counts[brand], seconds, now)
+        if stats.tier != before.tier:
+            log.info(
+                "Brand changed tier",
+                brand=brand,
+                tier=stats.tier,
+                daily_rate=round(stats.daily_rate, 2),
+            )
+        items.append(to_item(source, stats))
+
+    dynamodb = get_client("dynamodb")
+    for i in range(0, len(items), 25):
+        request = {table_name: [{"PutRequest": {"Item": item}} for item in items[i : i + 25]]}
+        while request:
+            response = dynamodb.batch_write_item(RequestItems=request)
+            request = response.get("UnprocessedItems")
+
+
+def update_stats(stats: BrandStats, new_count: int, seconds: float, now: float) -> BrandStats:
+    latency_ms = seconds * 1000
+    if stats.runs == 0:
+        # Everything a brand has listed counts as new on its first run, so
+        # only its latency says something
+        return stats._replace(latency_ms=latency_ms, last_run=now, runs=1)
+
+    elapsed = max(now - stats.last_run, MIN_ELAPSED_SECONDS)
+    daily_rate = new_count * 86400 / elapsed
+    if stats.runs > 1:
+        daily_rate = SMOOTHING * daily_rate + (1 - SMOOTHING) * stats.daily_rate
+    latency_ms = SMOOTHING * latency_ms + (1 - SMOOTHING) * stats.latency_ms
+
+    return stats._replace(
+        tier=get_tier(daily_rate),
+        daily_rate=daily_rate,
+        latency_ms=latency_ms,
+        last_run=now,
+        runs=stats.runs + 1,
+    )
+
+
+def to_item(source: str, stats: BrandStats) -> dict:
+    return {
+        "source": {"S": source},
+        "brand": {"S": stats.brand},
+        "tier": {"S": stats.tier},
+        "daily_rate": {"N": f"{stats.daily_rate:.3f}"},
+        "latency_ms": {"N": f"{stats.latency_ms:.0f}"},
+        "last_run": {"N": f"{stats.last_run:.0f}"},
+        "runs": {"N": str(stats.runs)},
+    }
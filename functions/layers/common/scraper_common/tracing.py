@@ -0,0 +1,158 @@
+"""Lightweight tracing from the scrapers through SQS to email-send.
+
+Spans follow the OpenTelemetry model: a trace id shared by the whole run, a
+span id per unit of work and the id of the parent span. ``span()`` nests
+under the current span of the calling context, ``inject()`` adds a W3C
+``traceparent`` to an SQS message and ``extract()`` reads it back in the
+consumer, so email-send continues the trace that found the listings.
+
+Every span also carries the time its trace was started, which lets
+email-send report the time from scrape to send without a trace backend.
+
+Finished spans go to the exporter picked with TRACE_EXPORTER: ``log``
+(default, a DEBUG record per span through scraper_common.log, so LOG_LEVEL
+and LOG_FORMAT apply and the span lines count in log.bytes), ``file`` (JSON
+lines appended to TRACE_FILE), ``memory`` (kept in ``exporter.spans``) or
+``none``.
+"""
+import contextvars
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+
+SERVICE_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "local")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class SpanContext(NamedTuple):
+    trace_id: str
+    span_id: str
+    trace_started_at: float
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional[SpanContext], attributes: dict):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        if parent is None:
+            self.trace_id = secrets.token_hex(16)
+            self.parent_id = None
+            self.trace_started_at = time.time()
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.trace_started_at = parent.trace_started_at
+        self.attributes = attributes
+        self.status = "ok"
+        self.started_at = time.time()
+        self.ended_at = None
+
+    @property
+    def context(self) -> SpanContext:
+        return SpanContext(self.trace_id, self.span_id, self.trace_started_at)
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "service": SERVICE_NAME,
+            "start": self.started_at,
+            "duration_ms": round((self.ended_at - self.started_at) * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class LogExporter:
+    def export(self, span: dict):
+        # Imported here, log imports this module for the trace ids
+        from scraper_common import log
+
+        log.debug("Span finished", span=span)
+
+
+class FileExporter:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: dict):
+        with self._lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(span, default=str) + "\n")
+
+
+class MemoryExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span: dict):
+        self.spans.append(span)
+
+
+class NoopExporter:
+    def export(self, span: dict):
+        pass
+
+
+def create_exporter(name: str):
+    if name == "file":
+        return FileExporter(os.getenv("TRACE_FILE", "traces.jsonl"))
+    if name == "memory":
+        return MemoryExporter()
+    if name == "none":
+        return NoopExporter()
+    return LogExporter()
+
+
+exporter = create_exporter(os.getenv("TRACE_EXPORTER", "log"))
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, parent: Optional[SpanContext] = None, **attributes):
+    """Runs the block in a new span, a child of ``parent`` or of the current span."""
+    if parent is None and current_span() is not None:
+        parent = current_span().context
+
+    new_span = Span(name, parent, attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except Exception as e:
+        new_span.status = "error"
+        new_span.set_attribute("error", str(e))
+        raise
+    finally:
+        new_span.ended_at = time.time()
+        _current_span.reset(token)
+        exporter.export(new_span.to_dict())
+
+
+def inject(message: dict) -> dict:
+    """Adds the context of the current span to a message that is about to be sent."""
+    active = current_span()
+    if active is not None:
+        message["traceparent"] = f"00-{active.trace_id}-{active.span_id}-01"
+        message["trace_started_at"] = active.trace_started_at
+    return message
+
+
+def extract(message: dict) -> Optional[SpanContext]:
+    """Reads the span context from a received message, if it carries one."""
+    parts = message.get("traceparent", "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return SpanContext(parts[1], parts[2], message.get("trace_started_at", time.time()))
@@ -0,0 +1,122 @@
+"""Fetching and parsing Vinted catalog API results, shared by vinted-api and vinted-web.
+
+Items come from ``/api/v2/catalog/items``. Fields the API leaves out or sets
+to null get the same fallbacks in both scrapers, and an item without an id,
+url, image or price is skipped.
+"""
+from typing import Callable, List, Optional
+
+import requests
+
+from scraper_common import filters, log, metrics
+from scraper_common.listing import Listing
+
+THUMBNAIL_TYPE = "thumb310x430"
+
+
+def fetch_listings(
+    session: requests.Session,
+    source: str,
+    api_url: str,
+    brand: str,
+    brands: List[str],
+    headers: Optional[dict] = None,
+) -> List[Listing]:
+    """Fetches the newest items of ``brand`` with the source's filters and parses them.
+
+    ``api_url`` is the search url with a ``{}`` for the brand, ``brands`` the
+    approved brands items are checked against.
+    """
+    log.info("Scraping brand", brand=brand)
+    spec = filters.get_spec(source, brand)
+    url = filters.with_params(api_url.format(brand), filters.vinted_api_params(spec))
+
+    with metrics.stage("fetch", brand):
+        response = session.get(url, headers=headers)
+    metrics.add("fetch.bytes", len(response.content), metrics.BYTES)
+
+    try:
+        data = response.json()
+    except ValueError:
+        log.warning(
+            "Non-JSON response",
+            brand=brand,
+            status=response.status_code,
+            body=response.text[:500],
+        )
+        return []
+
+    items = data.get("items", [])
+    log.debug("Fetched items", brand=brand, count=len(items))
+
+    with metrics.stage("parse"):
+        listings = parse_items(items, brands, filters.compile_predicate(spec))
+
+    metrics.add("parse.items_in", len(items))
+    metrics.add("parse.items_out", len(listings))
+    metrics.add("listings", len(listings), brand=brand)
+    return listings
+
+
+def parse_items(
+    items: List[dict],
+    brands: List[str],
+    accept: Callable[[Listing], bool] = filters.accept_all,
+) -> List[Listing]:
+    listings = []
+    filtered = 0
+
+    for item in items:
+        listing = parse_item(item)
+
+        if not filters.is_approved_brand(listing.brand, brands):
+            log.debug("Brand not approved", brand=listing.brand, sample=0.05)
+            continue
+
+        if not is_valid(listing):
+            log.warning("Missing fields for listing", listing=listing, sample=0.1)
+            continue
+
+        if not accept(listing):
+            filtered += 1
+            continue
+
+        listings.append(listing)
+
+    metrics.add("filter.items_dropped", filtered)
+    return listings
+
+
+def parse_item(item: dict) -> Listing:
+    photo = item.get("photo") or {}
+    img_url = next(
+        (
+            thumb.get("url")
+            for thumb in photo.get("thumbnails") or []
+            if thumb.get("type") == THUMBNAIL_TYPE
+        ),
+        photo.get("url"),  # fallback to original photo url
+    )
+
+    price = item.get("total_item_price") or {}
+    amount = price.get("amount")
+
+    return Listing(
+        id=str(item["id"]) if item.get("id") else None,
+        brand=item.get("brand_title") or "",
+        url=item.get("url"),
+        img_url=img_url,
+        size=item.get("size_title") or "N/A",
+        condition=item.get("status") or "N/A",
+        currency=price.get("currency_code") or "",
+        price=float(amount) if amount else None,
+    )
+
+
+def is_valid(listing: Listing) -> bool:
+    return None not in (
+        listing.id,
+        listing.price,
+        listing.url,
+        listing.img_url,
+    )
@@ -1,17 +1,25 @@
-import json
 import time
 import pprint
-import boto3
 import os
+import resource
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from headless_chrome import create_driver
 from botocore.exceptions import ClientError
 from collections import defaultdict
-from datetime import datetime, timezone
 from dotenv import load_dotenv
-
-brands = [
+from scraper_common import capture, config, filters, log, metrics, planner, schedule
+from scraper_common.browser import WarmDriver
+from scraper_common.budget import Budget
+from scraper_common.clients import get_client
+from scraper_common.fanout import dispatch, run_locally
+from scraper_common.listing import Listing, parse_price
+from scraper_common.notify import deliver
+from scraper_common.profiling import profiled
+from scraper_common.render import CardTemplate, render_digest_pages
+
+# Used when /serverless-scraper/brands/sellpy is not set in SSM
+DEFAULT_BRANDS = [
     "fedeli",
     "piacenza",
     "fioroni",
@@ -45,120 +53,276 @@ brands = [
     "tumi",
 ]
 
+CARD_TEMPLATE = CardTemplate(("<b>{title}</b>", "<b>Price: {price}</b>"))
+
+SEARCH_URL = "https://www.sellpy.se/search?query={}&sortBy=saleStartedAt_desc"
+
+# Estimated time per brand when there are no stats for it yet
+BRAND_COST_MS = 30_000
+
+# Upper bound on result pages loaded per brand when every listing is new
+MAX_PAGES = int(os.getenv("SELLPY_MAX_PAGES", "5"))
+LOAD_MORE_WAIT_SECONDS = 3
+
+# Most keys one BatchGetItem request takes
+BATCH_GET_SIZE = 100
+
+# Scrolls to the end of the result list and presses the "show more" button
+# if the page has one, otherwise scrolling alone triggers the next batch
+LOAD_MORE_SCRIPT = """
+window.scrollTo(0, document.body.scrollHeight);
+var buttons = document.querySelectorAll("button");
+for (var i = 0; i < buttons.length; i++) {
+    if (/visa fler|show more|load more/i.test(buttons[i].textContent)) {
+        buttons[i].click();
+        break;
+    }
+}
+"""
+
 
+@profiled("sellpy")
+@metrics.instrumented("sellpy")
 def lambda_handler(event, context):
-    print("-----------handler started------------")
+    log.info("Handler started", action=event.get("action"))
 
-    raw_articles = scrape_articles()
-    parsed_articles = parse_articles(raw_articles)
-    new_articles = write_to_db(parsed_articles)
+    def scrape(brands, pending):
+        budget = Budget(context, "sellpy", BRAND_COST_MS)
+        scrape_articles(brands, budget, pending)
+        # Brands that did not fit go to a new invocation, these results are sent now
+        budget.continue_with(event)
 
-    if len(new_articles) > 0:
-        html = generate_html(new_articles)
-        html_s3_object_id = upload_html_to_s3(html)
-        push_event_to_sqs(html_s3_object_id, len(new_articles))
+    def notify(new_articles):
+        subject = f"⚡ {len(new_articles)} new Sellpy listings"
+        deliver("Sellpy", new_articles, CARD_TEMPLATE, subject, event)
 
-    return {"statusCode": 200, "body": json.dumps(len(new_articles))}
+    return dispatch(event, "sellpy", select_brands, scrape, notify)
 
 
-def scrape_articles():
+def create_browser():
+    # Records or replays the page sources when CAPTURE is set
     if os.getenv("ENVIRONMENT") == "local":
-        driver = webdriver.Chrome()
-    else:
-        driver = create_driver()
+        return capture.driver(webdriver.Chrome)
+    return capture.driver(create_driver)
+
+
+# Kept between warm invocations, and shared with vinted-web by the daemon
+browser = WarmDriver(create_browser)
+
 
-    raw_articles = []
-    baseUrl = "https://www.sellpy.se/search?query={}&sortBy=saleStartedAt_desc"
+def scrape_articles(brands_to_scrape, budget, pending):
+    """Scrapes and saves one brand at a time, its new listings are added to ``pending``."""
+    if not brands_to_scrape:
+        # Nothing in this tier, do not start the browser
+        return
 
-    for brand in brands:
-        print(f"Scraping brand: {brand}")
-        url = baseUrl.format(brand)
-        driver.get(url)
+    dynamodb = get_client("dynamodb")
 
+    with browser.use() as driver:
+        for brand in budget.brands(brands_to_scrape):
+            log.info("Scraping brand", brand=brand)
+            started = time.perf_counter()
+            brand_articles = scrape_brand(driver, dynamodb, brand, budget)
+            schedule.observe("sellpy", brand, brand_articles, time.perf_counter() - started)
+            metrics.add("listings", len(brand_articles), brand=brand)
+            # Saved right away, a run that fails on a later brand keeps this one
+            pending.add(write_to_db(brand_articles, pending.seen))
+
+            metrics.observe("memory.peak_rss", get_peak_rss_mb(), metrics.MEGABYTES)
+
+
+def scrape_brand(driver, dynamodb, brand, budget):
+    with metrics.stage("fetch", brand):
+        driver.get(SEARCH_URL.format(brand))
         time.sleep(7)
 
-        html = driver.page_source
-        soup = BeautifulSoup(html, "html.parser")
+    brand_articles = []
+    seen_ids = set()
+    # Sellpy's search has no filter parameters, everything is checked here
+    accept = filters.compile_predicate(filters.get_spec("sellpy", brand))
+
+    for page in range(1, MAX_PAGES + 1):
+        page_source = driver.page_source
+        metrics.add("fetch.bytes", len(page_source), metrics.BYTES)
+
+        with metrics.stage("parse"):
+            soup = BeautifulSoup(page_source, "html.parser")
+
+            # Earlier results stay in the page when more are loaded, only look
+            # at the ones that were added by the last step
+            articles = [
+                article
+                for article in soup.select("article:not(#clipResults-slider article)")
+                if get_article_id(article) not in seen_ids
+            ]
+            ids = [get_article_id(article) for article in articles]
+            seen_ids.update(ids)
+
+        # Results are sorted newest first, so everything from the first
+        # already stored listing and onwards was seen in an earlier run
+        with metrics.stage("lookup"):
+            known_index = find_first_known_index(dynamodb, ids)
+        articles = articles[:known_index]
+
+        log.info("Loaded page", brand=brand, page=page, new=len(articles), loaded=len(ids))
+
+        # Parse while the page is loaded and keep only Listings, so the
+        # parse tree can be freed before more results are loaded
+        with metrics.stage("parse"):
+            parsed = parse_articles(articles, accept)
+            soup.decompose()
+
+        metrics.add("parse.items_in", len(ids))
+        metrics.add("parse.items_out", len(parsed))
+        brand_articles += parsed
+
+        if known_index < len(ids) or not ids:
+            break
+        if page == MAX_PAGES:
+            log.info("Page budget reached", brand=brand, pages=MAX_PAGES)
+            break
+        if budget.is_exhausted():
+            log.warning("Out of time, not loading more pages", brand=brand, pages=page)
+            break
+
+        with metrics.stage("fetch", brand):
+            driver.execute_script(LOAD_MORE_SCRIPT)
+            time.sleep(LOAD_MORE_WAIT_SECONDS)
+
+    return brand_articles
+
+
+def get_article_id(article):
+    link = article.find("a")
+    href = link.get("href") if link else None
+    return href.split("/")[2] if href else None
+
+
+def find_first_known_index(dynamodb, ids):
+    """Index of the first id already stored in DynamoDB, or len(ids) if none is.
+
+    Unapproved, sold and filtered out articles are never stored, so stored
+    ids can sit anywhere between unstored ones. All ids of the page are looked
+    up at once and the first stored one in page order is where the earlier
+    runs left off.
+    """
+    known_ids = get_known_ids(dynamodb, ids)
+    return next(
+        (index for index, article_id in enumerate(ids) if article_id in known_ids),
+        len(ids),
+    )
 
-        articles = soup.select("article:not(#clipResults-slider article)")
 
-        print(len(articles))
-        raw_articles += articles
+def get_known_ids(dynamodb, ids):
+    table_name = os.environ["DYNAMO_TABLE"]
+    # BatchGetItem rejects duplicate keys
+    keys = [{"id": {"S": article_id}} for article_id in dict.fromkeys(ids) if article_id]
+    known_ids = set()
 
-    print("----------------------")
-    print(f"Scraped listings: {len(raw_articles)}")
-    return raw_articles
+    for i in range(0, len(keys), BATCH_GET_SIZE):
+        request = {
+            table_name: {"Keys": keys[i : i + BATCH_GET_SIZE], "ProjectionExpression": "id"}
+        }
+        while request:
+            response = dynamodb.batch_get_item(
+                RequestItems=request, ReturnConsumedCapacity="TOTAL"
+            )
+            metrics.add_consumed_capacity(response, "lookup")
+            known_ids.update(
+                item["id"]["S"] for item in response["Responses"].get(table_name, [])
+            )
+            request = response.get("UnprocessedKeys")
+
+    return known_ids
 
 
-def parse_articles(articles):
+def parse_articles(articles, accept=filters.accept_all):
     results = []
+    filtered = 0
 
     for article in articles:
-        data = {}
-
         # Brand
         meta_tag = article.find("meta", itemprop="brand")
-        data["brand"] = meta_tag.get("content") if meta_tag else None
+        brand = meta_tag.get("content") if meta_tag else None
 
-        if not is_approved_brand(data["brand"]):
-            print(f"'{data['brand']}' does not match any approved brand.")
+        if not is_approved_brand(brand):
+            log.debug("Brand not approved", brand=brand, sample=0.05)
             continue
 
         # Title
         item_tag = article.find("p")
-        data["title"] = item_tag.text if item_tag else None
+        title = item_tag.text if item_tag else None
 
         # Price
         price_tag = article.find("p", itemprop="price")
-        data["price"] = price_tag.text if price_tag else None
+        price_text = price_tag.text if price_tag else None
 
         # Url
         link = article.find("a")
         href = link.get("href") if link else None
         if href is None:
-            print("Skipping article - URL not found")
+            log.warning("Skipping article, URL not found", sample=0.1)
             continue
-        data["url"] = "https://www.sellpy.se" + href
-        data["id"] = href.split("/")[2]
 
         # Image
         image_tag = article.find("img")
-        data["img_url"] = image_tag.get("src") if image_tag else None
+        img_url = image_tag.get("src") if image_tag else None
 
         # Skip article if any required property is missing
-        if None in (
-            data["brand"],
-            data["title"],
-            data["price"],
-            data["url"],
-            data["img_url"],
-        ):
+        if None in (brand, title, price_text, img_url):
             continue
 
         # If price not set, article is sold
-        if "\xa0" in data["price"]:
+        if "\xa0" in price_text:
+            continue
+
+        price, currency = parse_price(price_text)
+        listing = Listing(
+            id=get_article_id(article),
+            brand=brand,
+            url="https://www.sellpy.se" + href,
+            img_url=img_url,
+            title=title,
+            currency=currency,
+            price=price,
+        )
+        if not accept(listing):
+            filtered += 1
             continue
 
-        results.append(data)
+        results.append(listing)
 
     # pprint.pp(parsed_articles)
-    print("----------------------")
-    print(f"Parsed listings: {len(results)}")
+    metrics.add("filter.items_dropped", filtered)
+    log.debug("Parsed listings", count=len(results))
     return results
 
 
-def write_to_db(articles):
-    dynamodb = boto3.client("dynamodb")
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_to_db(articles, seen=None):
+    dynamodb = get_client("dynamodb")
+
+    with metrics.stage("dedupe"):
+        # One listing can be found by several searches of the run, ``seen``
+        # holds the ids written for the brands before this one
+        new_items = write_new_articles(dynamodb, planner.drop_duplicates(articles, seen))
+
+    metrics.add("dedupe.items_in", len(articles))
+    metrics.add("dedupe.items_out", len(new_items))
+
+    log.summary("New listings saved", new_items, keys=("id", "brand", "price"))
+    return new_items
+
+
+def write_new_articles(dynamodb, articles):
     new_items = []
 
     for article in articles:
-        item = {
-            "id": {"S": article["id"]},
-            "brand": {"S": article["brand"]},
-            "title": {"S": article["title"]},
-            "url": {"S": article["url"]},
-            "img_url": {"S": article["img_url"]},
-        }
+        item = article.to_dynamo_item()
 
         condition_expression = "attribute_not_exists(id)"
 
@@ -167,7 +331,9 @@ def write_to_db(articles):
                 TableName=os.environ["DYNAMO_TABLE"],
                 Item=item,
                 ConditionExpression=condition_expression,
+                ReturnConsumedCapacity="TOTAL",
             )
+            metrics.add_consumed_capacity(response)
 
             new_items.append(article)
 
@@ -176,188 +342,95 @@ def write_to_db(articles):
                 # The condition expression was not met, indicating that the item already exists
                 continue
             else:
-                print(e)
+                log.error("Failed to save listing", id=article.id, error=str(e))
                 continue
 
-    print("-------------------------")
-    print(f"New listings saved: {len(new_items)}")
-    print(f"New listings: {new_items}")
     return new_items
 
 
-def upload_html_to_s3(html):
-    bucket_name = os.environ["S3_HTML_BUCKET"]
-    date_key = datetime.now(timezone.utc).strftime("%Y-%m-%d")  # e.g. "2025-06-28"
-    object_key = f"sellpy/{date_key}.html"
-
-    s3 = boto3.client("s3")
-    s3.put_object(
-        Bucket=bucket_name, Key=object_key, Body=html, ContentType="text/html"
-    )
-
-    print(f"Uploaded to s3://{bucket_name}/{object_key}")
-    return object_key
-
-
-def push_event_to_sqs(s3_object_id, nbr_of_new_listings):
-    sqs = boto3.client("sqs")
-    ssm = boto3.client("ssm")
-
-    sender_name = "Sellpy"
-    subject = f"⚡ {nbr_of_new_listings} new Sellpy listings"
-    recipient = ssm.get_parameter(Name="/ses/email/recipient")["Parameter"]["Value"]
-
-    message_body = json.dumps(
-        {"object_key": s3_object_id, "sender_name": sender_name, "subject": subject, "recipient": recipient}
-    )
-
-    response = sqs.send_message(
-        QueueUrl=os.environ["SQS_EMAIL_QUEUE"], MessageBody=message_body
-    )
-
-    print("-------------------------")
-    print("Message published to SQS:", response["MessageId"])
-
-
 def publish_to_sns(articles):
-    client = boto3.client("sns")
+    client = get_client("sns")
 
     subject = f"{len(articles)} new Sellpy listings"
     message = format_message(articles)
-    print(message)
+    log.debug("SNS message", message=message)
 
     response = client.publish(
         TopicArn=os.environ["SNS_ARN"], Message=message, Subject=subject
     )
 
-    print("-------------------------")
-    print("Message published to SNS:", response["MessageId"])
+    log.info("Message published to SNS", message_id=response["MessageId"])
 
 
 def send_email(articles):
-    ses = boto3.client("ses")
-    ssm = boto3.client("ssm")
+    ses = get_client("ses")
 
-    recipient = ssm.get_parameter(Name="/ses/email/recipient")["Parameter"]["Value"]
-    sender = ssm.get_parameter(Name="/ses/email/sender")["Parameter"]["Value"]
+    recipient = config.get_parameter(config.RECIPIENT_PARAMETER)
+    sender = config.get_parameter(config.SENDER_PARAMETER)
 
     subject = f"{len(articles)} new Sellpy listings"
-    html = generate_html(articles)
-
-    response = ses.send_email(
-        Source=sender,
-        Destination={"ToAddresses": [recipient]},
-        Message={
-            "Subject": {"Data": subject},
-            "Body": {"Html": {"Data": html}},
-        },
-    )
 
-    print("-------------------------")
-    print("Message published to SES:", response["MessageId"])
+    for html in generate_html_pages(articles):
+        response = ses.send_email(
+            Source=sender,
+            Destination={"ToAddresses": [recipient]},
+            Message={
+                "Subject": {"Data": subject},
+                "Body": {"Html": {"Data": html}},
+            },
+        )
+
+        log.info("Message published to SES", message_id=response["MessageId"])
+
+
+def get_brands():
+    return config.get_brands("sellpy", DEFAULT_BRANDS)
+
+
+def select_brands(event):
+    if "continuation" in event:
+        # Left over by an earlier invocation that ran out of time
+        return event["brands"]
+    # A scheduled run only scrapes the brands in the tier of its rule
+    brands = schedule.select_brands("sellpy", get_brands(), event.get("tier"))
+    return planner.plan_queries("sellpy", brands)
 
 
 def is_approved_brand(brand: str) -> bool:
-    if not brand:
-        return False
-    return any(approved_brand.lower() in brand.lower() for approved_brand in brands)
+    return filters.is_approved_brand(brand, get_brands())
 
 
 def format_message(articles):
     articles_by_brand = defaultdict(list)
     for article in articles:
-        articles_by_brand[article["brand"]].append(article)
+        articles_by_brand[article.brand].append(article)
 
     formatted_data = ""
     for brand, articles in articles_by_brand.items():
         formatted_data += f"{brand}\n\n"
         for article in articles:
             formatted_data += (
-                f"{article['title']} - {article['price']}\n{article['url']}\n"
+                f"{article.title} - {article.price_text}\n{article.url}\n"
             )
         formatted_data += "\n"
 
     return formatted_data
 
 
-def generate_html(articles):
-    brands = defaultdict(list)
-    for item in articles:
-        brands[item["brand"]].append(item)
+def generate_html_pages(articles):
+    with metrics.stage("render"):
+        pages = render_digest_pages(articles, CARD_TEMPLATE)
 
-    html = """<!DOCTYPE html>
-<html>
-<body style="font-family: Arial, sans-serif; font-size: 14px; color: #333; margin:0; padding:0;">
-"""
-
-    for brand, items in brands.items():
-        html += f"""
-  <table width="600" cellpadding="0" cellspacing="0" border="0" align="center" style="border-collapse: collapse; margin-bottom: 20px;">
-    <tr>
-      <td style="padding: 15px 0 5px 10px;">
-        <div style="font-weight: bold; font-size: 28px; padding-bottom: 10px;">
-          {brand}
-        </div>
-      </td>
-    </tr>
-    <tr><td style="height: 10px;"></td></tr>
-"""
-
-        # Rows with two columns per row
-        for i in range(0, len(items), 2):
-            html += "    <tr>\n"
-            for j in range(2):
-                if i + j < len(items):
-                    item = items[i + j]
-                    html += f"""      <td width="50%" valign="top" style="padding: 10px;">
-<table width="100%" cellpadding="0" cellspacing="0" border="0" style="border: 1px solid #ddd; border-collapse: collapse; font-family: Arial, sans-serif; font-size: 14px;">
-  <tr>
-    <td align="center" style="padding-bottom: 10px;">
-      <a href="{item["url"]}" target="_blank">
-        <img src="{item["img_url"]}" alt="" style="width: 100%; height: auto; display: block;">
-      </a>
-    </td>
-  </tr>
-  <tr>
-    <td align="left" style="padding: 10px; font-weight: bold; font-size: 16px; color: #222;">
-      {item["brand"]}
-    </td>
-  </tr>
-  <tr>
-    <td align="left" style="padding: 0 10px 0px 10px; color: #333;">
-      <b>{item["title"]}</b>
-    </td>
-  </tr>
-  <tr>
-    <td align="left" style="padding: 0 10px 5px 10px; color: #333;">
-      <b>Price: {item["price"]}</b>
-    </td>
-  </tr>
-  <tr>
-    <td align="left" style="padding: 0 10px 10px 10px; color: #777; font-size: 12px;">
-      ID: {item["id"]}
-    </td>
-  </tr>
-</table>
-      </td>
-"""
-                else:
-                    html += '      <td width="50%" valign="top" style="padding: 10px;"></td>\n'
-            html += "    </tr>\n"
-
-        html += "  </table>\n"
-
-    html += """</body>
-</html>
-"""
-
-    print("HTML generated.")
-    return html
+    log.debug("HTML generated", pages=len(pages))
+    return pages
 
 
 if __name__ == "__main__":
     load_dotenv()
     event = {}  # Provide any necessary event data here
     context = {}  # Provide any necessary context data here
-    result = lambda_handler(event, context)
+    if os.getenv("FANOUT") == "local":
+        result = run_locally(lambda_handler, event)
+    else:
+        result = lambda_handler(event, context)
     print(result)
@@ -0,0 +1,23 @@
+BASE_URL = "https://www.vinted.se/"
+CATALOG_URL = "https://www.vinted.se/catalog?search_text={}&order=newest_first&catalog[]=5&page=1"
+API_URL = "https://www.vinted.se/api/v2/catalog/items?page=1&per_page=96&search_text={}&catalog_ids=5&order=newest_first"
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/115.0.0.0 Safari/537.36"
+)
+
+BASE_HEADERS = {
+    "User-Agent": USER_AGENT,
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Encoding": "gzip, deflate",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Connection": "keep-alive",
+    "DNT": "1",
+    "Origin": BASE_URL,
+    "Referer": BASE_URL,
+}
+
+# Number of pooled connections kept open to vinted.se by the API session
+HTTP_POOL_SIZE = 4
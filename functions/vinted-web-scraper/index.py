@@ -1,18 +1,28 @@
-import json
 import time
 import pprint
-import boto3
 import os
+import resource
 import re
+import requests
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from headless_chrome import create_driver
 from botocore.exceptions import ClientError
 from collections import defaultdict
-from datetime import datetime, timezone
 from dotenv import load_dotenv
-
-brands = [
+from constants import BASE_URL, CATALOG_URL, API_URL, BASE_HEADERS, HTTP_POOL_SIZE
+from scraper_common import capture, config, filters, log, metrics, planner, schedule, vinted
+from scraper_common.browser import WarmDriver
+from scraper_common.budget import Budget
+from scraper_common.clients import get_client
+from scraper_common.fanout import dispatch
+from scraper_common.listing import Listing, parse_price
+from scraper_common.notify import deliver
+from scraper_common.profiling import profiled
+from scraper_common.render import CardTemplate, render_digest_pages
+
+# Used when /serverless-scraper/brands/vinted-web is not set in SSM
+DEFAULT_BRANDS = [
     "fedeli",
     "zanone",
     "finamore",
@@ -41,57 +51,167 @@ brands = [
     "tumi",
 ]
 
+# Estimated time per brand when there are no stats for it yet
+BRAND_COST_MS = 15_000
+
+CARD_TEMPLATE = CardTemplate(
+    (
+        "<b>Storlek:</b> {size}",
+        "<b>Skick:</b> {condition}",
+        "<b>Pris:</b> {price}",
+    )
+)
+
 
+@profiled("vinted-web")
+@metrics.instrumented("vinted-web")
 def lambda_handler(event, context):
-    print("-----------handler started------------")
+    log.info("Handler started", action=event.get("action"))
 
-    raw_articles = scrape_articles()
-    parsed_articles = parse_articles(raw_articles)
-    new_articles = write_to_db(parsed_articles)
+    def scrape(brands, pending):
+        budget = Budget(context, "vinted-web", BRAND_COST_MS)
+        if get_scrape_mode() == "hybrid":
+            fetch_articles(brands, budget, pending)
+        else:
+            scrape_articles(brands, budget, pending)
+        # Brands that did not fit go to a new invocation, these results are sent now
+        budget.continue_with(event)
+
+    def notify(new_articles):
+        subject = f"{len(new_articles)} new Vinted listings"
+        deliver("Vinted", new_articles, CARD_TEMPLATE, subject, event)
 
-    if len(new_articles) > 0:
-        html = generate_html(new_articles)
-        html_s3_object_id = upload_html_to_s3(html)
-        push_event_to_sqs(html_s3_object_id, len(new_articles))
+    return dispatch(event, "vinted-web", select_brands, scrape, notify)
 
-    return {"statusCode": 200, "body": json.dumps(len(new_articles))}
 
+def get_scrape_mode() -> str:
+    # "hybrid" only uses the browser to obtain session cookies and reads the
+    # catalog from the JSON API, "browser" renders every catalog page
+    return os.getenv("SCRAPE_MODE", "hybrid")
 
-def scrape_articles():
+
+def get_driver():
     if os.getenv("ENVIRONMENT") == "local":
-        driver = webdriver.Chrome()
-    else:
-        driver = create_driver()
+        return capture.driver(webdriver.Chrome)
+    return capture.driver(create_driver)
+
 
-    raw_articles = []
-    baseUrl = "https://www.vinted.se/catalog?search_text={}&order=newest_first&catalog[]=5&page=1"
+# Kept between warm invocations, and shared with sellpy by the daemon
+browser = WarmDriver(get_driver)
 
-    for brand in brands:
-        print(f"Scraping brand: {brand}")
-        url = baseUrl.format(brand)
-        driver.get(url)
+# Kept between warm invocations so its connections and cookies are reused
+api_session = None
 
+
+def fetch_articles(brands, budget, pending):
+    """Fetches and saves one brand at a time, its new listings are added to ``pending``."""
+    if not brands:
+        return
+
+    session = get_api_session()
+
+    for brand in budget.brands(brands):
+        started = time.perf_counter()
+        brand_articles = vinted.fetch_listings(
+            session, "vinted-web", API_URL, brand, get_brands()
+        )
+        schedule.observe("vinted-web", brand, brand_articles, time.perf_counter() - started)
+        # Saved right away, a run that fails on a later brand keeps this one
+        pending.add(write_to_db(brand_articles, pending.seen))
+        time.sleep(4)
+
+
+def get_api_session() -> requests.Session:
+    global api_session
+    if api_session is None:
+        api_session = requests.Session()
+        capture.mount(api_session, pool_maxsize=HTTP_POOL_SIZE, max_retries=2)
+        api_session.headers.update(BASE_HEADERS)
+    session = api_session
+
+    # Every run requests the front page, which also refreshes the token of a
+    # reused session. A plain request is enough as long as Vinted hands out a
+    # token to it
+    session.get(BASE_URL)
+    if session.cookies.get("access_token_web"):
+        return session
+
+    log.info("No access token from plain HTTP, bootstrapping session with browser")
+    bootstrap_session_with_browser(session)
+    return session
+
+
+def bootstrap_session_with_browser(session: requests.Session):
+    with browser.use() as driver:
+        driver.get(BASE_URL)
         time.sleep(7)
 
-        html = driver.page_source
-        soup = BeautifulSoup(html, "html.parser")
+        for cookie in driver.get_cookies():
+            session.cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie.get("domain"),
+                path=cookie.get("path", "/"),
+            )
+
+        # Cookies are tied to the client that received them, so keep the
+        # API requests looking like the browser
+        session.headers["User-Agent"] = driver.execute_script(
+            "return navigator.userAgent"
+        )
+
+    if not session.cookies.get("access_token_web"):
+        log.warning("Browser bootstrap did not yield an access token")
 
-        articles = soup.find_all("div", {"data-testid": "grid-item"})
 
-        print(len(articles))
-        raw_articles += articles
+def scrape_articles(brands, budget, pending):
+    """Scrapes and saves one brand at a time, its new listings are added to ``pending``."""
+    if not brands:
+        return
 
-    print("----------------------")
-    print(f"Scraped listings: {len(raw_articles)}")
-    return raw_articles
+    with browser.use() as driver:
+        for brand in budget.brands(brands):
+            log.info("Scraping brand", brand=brand)
+            started = time.perf_counter()
+            spec = filters.get_spec("vinted-web", brand)
+            url = filters.with_params(
+                CATALOG_URL.format(brand), filters.vinted_catalog_params(spec)
+            )
+            with metrics.stage("fetch", brand):
+                driver.get(url)
+
+                time.sleep(7)
+
+            page_source = driver.page_source
+            metrics.add("fetch.bytes", len(page_source), metrics.BYTES)
+
+            with metrics.stage("parse"):
+                soup = BeautifulSoup(page_source, "html.parser")
+
+                articles = soup.find_all("div", {"data-testid": "grid-item"})
+
+                log.debug("Loaded articles", brand=brand, count=len(articles))
+
+                # Parse while the page is loaded and keep only Listings, so the
+                # parse tree can be freed before the next brand is fetched
+                brand_articles = parse_articles(articles, filters.compile_predicate(spec))
+                soup.decompose()
+
+            metrics.add("parse.items_in", len(articles))
+            metrics.add("parse.items_out", len(brand_articles))
+            metrics.add("listings", len(brand_articles), brand=brand)
+            schedule.observe("vinted-web", brand, brand_articles, time.perf_counter() - started)
+            # Saved right away, a run that fails on a later brand keeps this one
+            pending.add(write_to_db(brand_articles, pending.seen))
 
+            metrics.observe("memory.peak_rss", get_peak_rss_mb(), metrics.MEGABYTES)
 
-def parse_articles(articles):
+
+def parse_articles(articles, accept=filters.accept_all):
     results = []
+    filtered = 0
 
     for article in articles:
-        data = {}
-
         # Extract brand and assert its correct
         brand_tag = article.find(
             "p",
@@ -101,14 +221,10 @@ def parse_articles(articles):
         brand = brand_tag.text if brand_tag else "Brand not found"
 
         # Check if the brand matches or contains any approved brand (case-insensitive)
-        if any(approved_brand.lower() in brand.lower() for approved_brand in brands):
-            print(f"'{brand}' matches an approved brand.")
-        else:
-            print(f"'{brand}' does not match any approved brand.")
+        if not is_approved_brand(brand):
+            log.debug("Brand not approved", brand=brand, sample=0.05)
             continue
 
-        data["brand"] = brand
-
         # Extract size
         size_tag = article.find(
             "p",
@@ -118,15 +234,11 @@ def parse_articles(articles):
         if size_tag:
             text = size_tag.text.strip()
             if "·" in text:
-                size_text, condition_text = map(str.strip, text.split("·", 1))
-                data["size"] = size_text
-                data["condition"] = condition_text
+                size, condition = map(str.strip, text.split("·", 1))
             else:
-                data["size"] = "N/A"
-                data["condition"] = text
+                size, condition = "N/A", text
         else:
-            data["size"] = "N/A"
-            data["condition"] = "N/A"
+            size, condition = "N/A", "N/A"
 
         # Extract price with fee
         price_with_fee_tag = article.find(
@@ -134,65 +246,101 @@ def parse_articles(articles):
             class_="web_ui__Text__text web_ui__Text__caption web_ui__Text__left web_ui__Text__muted",
             attrs={"data-testid": lambda x: x and "price-text" in x},
         )
-        data["price"] = (
-            price_with_fee_tag.text
-            if price_with_fee_tag
-            else "Price with fee not found"
+        price, currency = parse_price(
+            price_with_fee_tag.text if price_with_fee_tag else None
         )
 
         # Url
         link = article.find("a", class_="new-item-box__overlay")
         href = link.get("href") if link else None
         if href is None:
-            print("Skipping article - URL not found")
+            log.warning("Skipping article, URL not found", sample=0.1)
             continue
-        data["url"] = href
         match = re.search(r"/items/(\d+)-", href)  #   href.split('/')[4]
 
         if match:
-            data["id"] = match.group(1)  # Extract the number part
+            item_id = match.group(1)  # Extract the number part
         else:
-            print("No item number found in the URL")
+            item_id = None
+            log.warning("No item number found in the URL", url=href, sample=0.1)
 
         # Img url
         img_div = article.find("div", class_="web_ui__Image__portrait")
         img_tag = img_div.find("img")
         if img_tag and "src" in img_tag.attrs:
-            data["img_url"] = img_tag["src"]
+            img_url = img_tag["src"]
         else:
-            print("No image tag found inside the div.")
-
-        # Skip article if any required property is missing
-        if None in (
-            data["id"],
-            data["brand"],
-            data["price"],
-            data["url"],
-            data["img_url"],
-        ):
+            img_url = None
+            log.warning("No image tag found inside the div", sample=0.1)
+
+        # Skip article if any required property is missing, a listing
+        # without a price with fee is still reported
+        if None in (item_id, img_url):
+            continue
+
+        listing = Listing(
+            id=item_id,
+            brand=brand,
+            url=href,
+            img_url=img_url,
+            size=size,
+            condition=condition,
+            currency=currency,
+            price=price,
+        )
+        if not accept(listing):
+            filtered += 1
             continue
 
-        results.append(data)
+        results.append(listing)
 
-    print("----------------------")
-    print(f"Parsed listings: {len(results)}")
+    metrics.add("filter.items_dropped", filtered)
+    log.debug("Parsed listings", count=len(results))
     return results
 
 
-def write_to_db(articles):
-    dynamodb = boto3.client("dynamodb")
+def get_brands():
+    return config.get_brands("vinted-web", DEFAULT_BRANDS)
+
+
+def select_brands(event):
+    if "continuation" in event:
+        # Left over by an earlier invocation that ran out of time
+        return event["brands"]
+    # A scheduled run only scrapes the brands in the tier of its rule
+    brands = schedule.select_brands("vinted-web", get_brands(), event.get("tier"))
+    return planner.plan_queries("vinted-web", brands)
+
+
+def is_approved_brand(brand: str) -> bool:
+    return filters.is_approved_brand(brand, get_brands())
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_to_db(articles, seen=None):
+    dynamodb = get_client("dynamodb")
+
+    with metrics.stage("dedupe"):
+        # One listing can be found by several searches of the run, ``seen``
+        # holds the ids written for the brands before this one
+        new_items = write_new_articles(dynamodb, planner.drop_duplicates(articles, seen))
+
+    metrics.add("dedupe.items_in", len(articles))
+    metrics.add("dedupe.items_out", len(new_items))
+
+    log.summary("New listings saved", new_items, keys=("id", "brand", "price"))
+    return new_items
+
+
+def write_new_articles(dynamodb, articles):
     new_items = []
 
     for article in articles:
-        item = {
-            "id": {"S": article["id"]},
-            "brand": {"S": article["brand"]},
-            "price": {"S": article["price"]},
-            "size": {"S": article["size"]},
-            "condition": {"S": article["condition"]},
-            "url": {"S": article["url"]},
-            "img_url": {"S": article["img_url"]},
-        }
+        item = article.to_dynamo_item()
 
         condition_expression = "attribute_not_exists(id)"
 
@@ -201,7 +349,9 @@ def write_to_db(articles):
                 TableName=os.environ["DYNAMO_TABLE"],
                 Item=item,
                 ConditionExpression=condition_expression,
+                ReturnConsumedCapacity="TOTAL",
             )
+            metrics.add_consumed_capacity(response)
 
             new_items.append(article)
 
@@ -210,50 +360,14 @@ def write_to_db(articles):
                 # The condition expression was not met, indicating that the item already exists
                 continue
             else:
-                print(e)
+                log.error("Failed to save listing", id=article.id, error=str(e))
                 continue
 
-    print("-------------------------")
-    print(f"New listings saved: {len(new_items)}")
-    print(f"New listings: {new_items}")
     return new_items
 
 
-def upload_html_to_s3(html):
-    bucket_name = os.environ["S3_HTML_BUCKET"]
-    date_key = datetime.now(timezone.utc).strftime("%Y-%m-%d")  # e.g. "2025-06-28"
-    object_key = f"vinted/{date_key}.html"
-
-    s3 = boto3.client("s3")
-    s3.put_object(
-        Bucket=bucket_name, Key=object_key, Body=html, ContentType="text/html"
-    )
-
-    print(f"Uploaded to s3://{bucket_name}/{object_key}")
-    return object_key
-
-
-def push_event_to_sqs(s3_object_id, nbr_of_new_listings):
-    sqs = boto3.client("sqs")
-    ssm = boto3.client("ssm")
-
-    subject = f"{nbr_of_new_listings} new Vinted listings"
-    recipient = ssm.get_parameter(Name="/ses/email/recipient")["Parameter"]["Value"]
-
-    message_body = json.dumps(
-        {"object_key": s3_object_id, "subject": subject, "recipient": recipient}
-    )
-
-    response = sqs.send_message(
-        QueueUrl=os.environ["SQS_EMAIL_QUEUE"], MessageBody=message_body
-    )
-
-    print("-------------------------")
-    print("Message published to SQS:", response["MessageId"])
-
-
 def publish_to_sns(articles):
-    client = boto3.client("sns")
+    client = get_client("sns")
 
     subject = f"{len(articles)} new Vinted listings"
     message = format_message(articles)
@@ -262,126 +376,51 @@ def publish_to_sns(articles):
         TopicArn=os.environ["SNS_ARN"], Message=message, Subject=subject
     )
 
-    print("-------------------------")
-    print("Message published to SNS:", response["MessageId"])
+    log.info("Message published to SNS", message_id=response["MessageId"])
 
 
 def send_email(articles):
-    ses = boto3.client("ses")
-    ssm = boto3.client("ssm")
+    ses = get_client("ses")
 
-    recipient = ssm.get_parameter(Name="/ses/email/recipient")["Parameter"]["Value"]
-    sender = ssm.get_parameter(Name="/ses/email/sender")["Parameter"]["Value"]
+    recipient = config.get_parameter(config.RECIPIENT_PARAMETER)
+    sender = config.get_parameter(config.SENDER_PARAMETER)
 
     subject = f"{len(articles)} new Vinted listings"
-    html = generate_html(articles)
-
-    response = ses.send_email(
-        Source=sender,
-        Destination={"ToAddresses": [recipient]},
-        Message={
-            "Subject": {"Data": subject},
-            "Body": {"Html": {"Data": html}},
-        },
-    )
 
-    print("-------------------------")
-    print("Message published to SES:", response["MessageId"])
+    for html in generate_html_pages(articles):
+        response = ses.send_email(
+            Source=sender,
+            Destination={"ToAddresses": [recipient]},
+            Message={
+                "Subject": {"Data": subject},
+                "Body": {"Html": {"Data": html}},
+            },
+        )
+
+        log.info("Message published to SES", message_id=response["MessageId"])
 
 
 def format_message(articles):
     articles_by_brand = defaultdict(list)
     for article in articles:
-        articles_by_brand[article["brand"]].append(article)
+        articles_by_brand[article.brand].append(article)
 
     formatted_data = ""
     for brand, articles in articles_by_brand.items():
         formatted_data += f"{brand}\n\n"
         for article in articles:
-            formatted_data += f"{article['price']}\n{article['url']}\n"
+            formatted_data += f"{article.price_text}\n{article.url}\n"
         formatted_data += "\n"
 
     return formatted_data
 
 
-def generate_html(articles):
-    brands = defaultdict(list)
-    for item in articles:
-        brands[item["brand"]].append(item)
-
-    html = """<!DOCTYPE html>
-<html>
-<body style="font-family: Arial, sans-serif; font-size: 14px; color: #333; margin:0; padding:0;">
-"""
-
-    for brand, items in brands.items():
-        html += f"""
-  <table width="600" cellpadding="0" cellspacing="0" border="0" align="center" style="border-collapse: collapse; margin-bottom: 20px;">
-    <tr>
-      <td style="padding: 15px 0 5px 10px;">
-        <div style="font-weight: bold; font-size: 28px; padding-bottom: 10px;">
-          {brand}
-        </div>
-      </td>
-    </tr>
-    <tr><td style="height: 10px;"></td></tr>
-"""
-
-        # Rows with two columns per row
-        for i in range(0, len(items), 2):
-            html += "    <tr>\n"
-            for j in range(2):
-                if i + j < len(items):
-                    item = items[i + j]
-                    html += f"""      <td width="50%" valign="top" style="padding: 10px;">
-<table width="100%" cellpadding="0" cellspacing="0" border="0" style="border: 1px solid #ddd; border-collapse: collapse; font-family: Arial, sans-serif; font-size: 14px;">
-  <tr>
-    <td align="center" style="padding-bottom: 10px;">
-      <a href="{item["url"]}" target="_blank">
-        <img src="{item["img_url"]}" alt="" style="width: 100%; height: auto; display: block;">
-      </a>
-    </td>
-  </tr>
-  <tr>
-    <td align="left" style="padding: 10px; font-weight: bold; font-size: 16px; color: #222;">
-      {item["brand"]}
-    </td>
-  </tr>
-  <tr>
-    <td align="left" style="padding: 0 10px 0px 10px; color: #333;">
-      <b>Storlek:</b> {item["size"]}
-    </td>
-  </tr>
-  <tr>
-    <td align="left" style="padding: 0 10px 0px 10px; color: #333;">
-      <b>Skick:</b> {item["condition"]}
-    </td>
-  </tr>
-  <tr>
-    <td align="left" style="padding: 0 10px 5px 10px; color: #333;">
-      <b>Pris:</b> {item["price"]}
-    </td>
-  </tr>
-  <tr>
-    <td align="left" style="padding: 0 10px 10px 10px; color: #777; font-size: 12px;">
-      ID: {item["id"]}
-    </td>
-  </tr>
-</table>
-      </td>
-"""
-                else:
-                    html += '      <td width="50%" valign="top" style="padding: 10px;"></td>\n'
-            html += "    </tr>\n"
-
-        html += "  </table>\n"
-
-    html += """</body>
-</html>
-"""
-
-    print("HTML generated.")
-    return html
+def generate_html_pages(articles):
+    with metrics.stage("render"):
+        pages = render_digest_pages(articles, CARD_TEMPLATE)
+
+    log.debug("HTML generated", pages=len(pages))
+    return pages
 
 
 if __name__ == "__main__":
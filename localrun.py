@@ -0,0 +1,49 @@
+"""Imports the Lambda functions outside Lambda, for the daemon, the bench and the tests.
+
+Importing this module changes neither the environment nor ``sys.path``, so
+each caller keeps its own configuration.
+"""
+import importlib.util
+import pathlib
+import sys
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parent
+FUNCTIONS_DIR = ROOT_DIR / "functions"
+COMMON_LAYER_DIR = FUNCTIONS_DIR / "layers" / "common"
+
+# Helper modules with the same name in several function directories
+FUNCTION_LOCAL_MODULES = ("constants", "headless_chrome")
+
+
+def load_function(directory: str, prefix: str = "local"):
+    """Imports a function's index.py as a new module, like a fresh Lambda container.
+
+    Each call gets its own copy of the function's helper modules. The module
+    is named ``<prefix>_<directory>``. The shared layer has to be importable,
+    i.e. COMMON_LAYER_DIR on ``sys.path``.
+    """
+    path = FUNCTIONS_DIR / directory
+    for name in FUNCTION_LOCAL_MODULES:
+        sys.modules.pop(name, None)
+
+    sys.path.insert(0, str(path))
+    try:
+        name = f"{prefix}_" + directory.replace("-", "_")
+        spec = importlib.util.spec_from_file_location(name, path / "index.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(path))
+    return module
+
+
+def reset_common_state():
+    """Drops what the shared layer keeps between warm invocations."""
+    from scraper_common import clients, config
+
+    clients._clients.clear()
+    clients.client_init_ms.clear()
+    config._parameters = {}
+    config._loaded_at = 0.0
+    config._lists.clear()
+    config._documents.clear()
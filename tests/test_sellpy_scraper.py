@@ -0,0 +1,55 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+from localrun import COMMON_LAYER_DIR, load_function, reset_common_state
+
+TABLE_NAME = "articles"
+
+
+@pytest.fixture
+def sellpy(monkeypatch):
+    monkeypatch.syspath_prepend(str(COMMON_LAYER_DIR))
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-north-1")
+    monkeypatch.setenv("DYNAMO_TABLE", TABLE_NAME)
+
+    with mock_aws():
+        boto3.setup_default_session()
+        module = load_function("sellpy-scraper", prefix="test")
+        # Clients cached by an earlier test belong to its mock
+        reset_common_state()
+        boto3.client("dynamodb").create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield module
+        reset_common_state()
+
+
+def store(*ids):
+    dynamodb = boto3.client("dynamodb")
+    for article_id in ids:
+        dynamodb.put_item(TableName=TABLE_NAME, Item={"id": {"S": article_id}})
+
+
+def test_first_known_index_skips_unstored_ids(sellpy):
+    # n: new, u: unapproved or filtered out and never stored, s: stored
+    store("s4", "s9")
+    ids = ["n1", "n2", "u3", "s4", "u5", "u6", "u7", "u8", "s9", "u10"]
+
+    assert sellpy.find_first_known_index(boto3.client("dynamodb"), ids) == 3
+
+
+def test_first_known_index_without_stored_ids(sellpy):
+    ids = ["n1", None, "n1", "u2"]
+
+    assert sellpy.find_first_known_index(boto3.client("dynamodb"), ids) == len(ids)
+
+
+def test_first_known_index_looks_up_more_than_one_batch(sellpy):
+    store("s250")
+    ids = [f"n{index}" for index in range(250)] + ["s250"]
+
+    assert sellpy.find_first_known_index(boto3.client("dynamodb"), ids) == 250